@@ -0,0 +1,334 @@
+"""
+    Benchmark cleaning, pair matching and end-to-end matching, on synthetic (seeded) business names
+"""
+
+import os
+import csv
+import random
+import shutil
+import platform
+import tempfile
+import subprocess
+import Levenshtein
+import numpy as np
+import multiprocessing as mp
+from datetime import date, datetime
+from time     import perf_counter
+import fio
+import match
+from compare  import *
+from support  import *
+from settings import *
+
+try:                import resource
+except ImportError: resource = None   # no memory peaks (e.g. on Windows)
+
+BENCH_REPEAT    = 3      # times to time clean_name and _match_names over their names (the fastest time counts)
+BENCH_TOLERANCE = 0.10   # slow down (or memory growth) beyond which compare_results flags a benchmark
+
+
+# SYNTHETIC NAMES ------------------------------------------------------------------------------------------------------
+
+_SYLLABLES = ['al', 'am', 'an', 'ar', 'ax', 'ba', 'bel', 'bio', 'ca', 'cor', 'da', 'del', 'en', 'ex', 'fa', 'gen',
+              'hal', 'in', 'ja', 'ka', 'ki', 'lo', 'lu', 'ma', 'med', 'mi', 'mo', 'na', 'neo', 'no', 'o', 'pa', 'ra',
+              'ri', 'ro', 'sa', 'si', 'ta', 'te', 'tra', 'u', 'va', 'vi', 'vo', 'xa', 'ze', 'zo']
+_SURNAMES  = ['Adams', 'Baker', 'Bauer', 'Becker', 'Brown', 'Campbell', 'Chen', 'Clark', 'Davis', 'Dubois', 'Evans',
+              'Fischer', 'Garcia', 'Hall', 'Hoffmann', 'Ito', 'Jones', 'Kato', 'Kim', 'Lee', 'Lopez', 'Martin',
+              'Meyer', 'Miller', 'Moore', 'Muller', 'Nakamura', 'Nguyen', 'Parker', 'Patel', 'Rossi', 'Schmidt',
+              'Schneider', 'Singh', 'Smith', 'Suzuki', 'Tanaka', 'Taylor', 'Wagner', 'Walker', 'Wang', 'Weber',
+              'Williams', 'Wilson', 'Wright', 'Young', 'Zhang']
+_PLACES    = ['American', 'Asia Pacific', 'Atlantic', 'Canadian', 'Central', 'China', 'Continental', 'Eastern',
+              'European', 'First', 'General', 'Global', 'Great Lakes', 'Gulf', 'Hong Kong', 'India', 'International',
+              'Japan', 'Midwest', 'National', 'New England', 'Nordic', 'North American', 'Northern', 'Pacific',
+              'Southern', 'Texas', 'United', 'Universal', 'Western', 'World']
+_WORDS     = ['Aerospace', 'Airlines', 'Analytics', 'Automotive', 'Bancorp', 'Bank', 'Biosciences', 'Biotech',
+              'Brands', 'Capital', 'Chemical', 'Communications', 'Computer', 'Construction', 'Consulting', 'Data',
+              'Devices', 'Diagnostics', 'Electric', 'Electronics', 'Energy', 'Engineering', 'Entertainment',
+              'Equipment', 'Financial', 'Foods', 'Gas', 'Genetics', 'Health', 'Healthcare', 'Industries',
+              'Instruments', 'Insurance', 'Investments', 'Laboratories', 'Logistics', 'Machinery', 'Management',
+              'Manufacturing', 'Media', 'Medical', 'Metals', 'Mining', 'Motors', 'Networks', 'Oil', 'Partners',
+              'Pharmaceuticals', 'Power', 'Properties', 'Realty', 'Resources', 'Retail', 'Semiconductor', 'Services',
+              'Shipping', 'Software', 'Solutions', 'Steel', 'Systems', 'Technologies', 'Telecom', 'Therapeutics',
+              'Trading', 'Transport', 'Trust', 'Ventures', 'Wireless']
+_SUFFIXES  = ['Inc', 'Inc.', 'Corp', 'Corp.', 'Corporation', 'Co', 'Co Ltd', 'Company', 'Ltd', 'Limited', 'LLC',
+              'LP', 'PLC', 'SA', 'AG', 'GmbH', 'NV', 'AB', 'KK', 'Pty Ltd', 'Holdings', 'Holdings Inc', 'Group',
+              'Group Ltd']
+_ABBREVS   = {'International': 'Intl', 'Technologies': 'Tech', 'Laboratories': 'Labs', 'Manufacturing': 'Mfg',
+              'Pharmaceuticals': 'Pharma', 'Communications': 'Comm', 'Corporation': 'Corp', 'Company': 'Co',
+              'Systems': 'Sys', 'Services': 'Svcs', 'Industries': 'Inds', 'Engineering': 'Eng', 'and': '&',
+              'American': 'Amer', 'National': 'Natl', 'Financial': 'Finl', 'Investments': 'Invest'}
+_LETTERS   = 'abcdefghijklmnopqrstuvwxyz'
+_FIRST_DAY = date(1990, 1, 1).toordinal()
+_LAST_DAY  = date(2019, 12, 31).toordinal()
+
+def synth_firm(firm, universe=0):
+    """
+    Base name and date (ordinal) of synthetic firm number firm, the same for the same firm and universe in any
+    process (so lists of any size can draw on the same firms without holding them in memory).
+    """
+    rng    = random.Random(universe << 40 | firm)
+    coined = ''.join(rng.choice(_SYLLABLES) for _ in range(rng.randint(2, 4))).capitalize()
+    shape  = rng.random()
+    if   shape < 0.30: words = [coined, rng.choice(_WORDS)]
+    elif shape < 0.45: words = [coined]
+    elif shape < 0.65: words = [rng.choice(_SURNAMES), rng.choice(_WORDS)]
+    elif shape < 0.75: words = [rng.choice(_SURNAMES), 'and', rng.choice(_SURNAMES)]
+    elif shape < 0.90: words = [rng.choice(_PLACES), rng.choice(_WORDS)]                  # generic names
+    else:              words = [rng.choice(_PLACES), coined, rng.choice(_WORDS)]
+    return ' '.join(words), rng.randint(_FIRST_DAY, _LAST_DAY)
+
+def synth_name(name, rng, typo_rate=0.2):
+    """One way a name might be written: abbreviations, a typo (typo_rate of the time), case and a corp suffix."""
+    name = ' '.join(_ABBREVS.get(w, w) if rng.random() < 0.3 else w for w in name.split())
+    if rng.random() < typo_rate: name = synth_typo(name, rng)
+    shape = rng.random()
+    if   shape < 0.4: name = name.upper()
+    elif shape < 0.5: name = name.lower()
+    if rng.random() < 0.8: name += (',' if rng.random() < 0.2 else '') + ' ' + rng.choice(_SUFFIXES)
+    return name
+
+def synth_typo(name, rng):
+    """name with one char substituted, dropped, added or swapped with the next (never its first char)."""
+    if len(name) < 3: return name
+    i     = rng.randrange(1, len(name) - 1)
+    shape = rng.random()
+    if shape < 0.35: return name[:i] + rng.choice(_LETTERS) + name[i + 1:]
+    if shape < 0.60: return name[:i] + name[i + 1:]
+    if shape < 0.85: return name[:i] + rng.choice(_LETTERS) + name[i:]
+    return name[:i] + name[i + 1] + name[i] + name[i + 2:]
+
+def synth_rows(n, seed=0, n_firms=None, universe=0, typo_rate=0.2, undated=0.1, days=10):
+    """
+    Generate a synthetic list of business names (in constant memory, for lists of any size).
+
+    Args:
+        n:              number of rows
+        seed:           seed of the rows (which firms, and how they are written)
+        n_firms:        number of firms the rows are drawn from (default n // 2, so most firms show up more than once)
+        universe:       seed of the firms themselves (lists with the same universe and n_firms share their firms)
+        typo_rate:      share of rows with a typo
+        undated:        share of rows without a date
+        days:           max days that a row's date lies away from its firm's date
+
+    Return:
+        generator of [raw_name, date] rows (date in DATE_FORMAT, or '')
+    """
+    rng     = random.Random(seed)
+    n_firms = n_firms or max(n // 2, 1)
+    for _ in range(n):
+        name, day = synth_firm(rng.randrange(n_firms), universe)
+        if rng.random() < undated: yield [synth_name(name, rng, typo_rate), '']
+        else: yield [synth_name(name, rng, typo_rate), _format_day(day + rng.randint(-days, days))]
+
+def perturb_rows(fname, n, seed=0, typo_rate=0.5, unknown=0.3, days=3):
+    """
+    Generate a focal list of about n names for an existing list fname: most of them are rows of fname with a
+    typo (typo_rate of the time), a new case or suffix and a shifted date, and an unknown share are new firms.
+
+    Return:
+        generator of [raw_name, date] rows
+    """
+    rng    = random.Random(seed)
+    n_rows = max(sum(1 for _ in fio.read_csv(fname)), 1)
+    for row in fio.read_csv(fname):
+        for _ in range(_draws(rng, unknown * n / n_rows)):
+            name, day = synth_firm(rng.randrange(1 << 30), universe=seed + 1)
+            yield [synth_name(name, rng, typo_rate), _format_day(day)]
+        if not row: continue
+        name = row[0]
+        for suffix in _SUFFIXES:
+            if name.endswith(' ' + suffix):
+                name = name[:-len(suffix) - 1]
+                break
+        for _ in range(_draws(rng, (1 - unknown) * n / n_rows)):
+            d = row[1] if len(row) > 1 else ''
+            if d: d = _format_day(datetime.strptime(d, DATE_FORMAT).toordinal() + rng.randint(-days, days))
+            yield [synth_name(name, rng, typo_rate), d]
+
+def save_rows(rows, fname):
+    """Save rows to a CSV file a row at a time (for lists too large to hold in memory)."""
+    with open(fname, 'w', encoding='utf-8', newline='') as f:
+        csv.writer(f, dialect='excel').writerows(rows)
+
+def _draws(rng, mean):
+    """How many times to draw a row, mean times on average (so lists can shrink or grow to any size)."""
+    return int(mean) + (rng.random() < mean - int(mean))
+
+def _format_day(day):
+    return date.fromordinal(day).strftime(DATE_FORMAT)
+
+
+# BENCHMARKS -----------------------------------------------------------------------------------------------------------
+
+def run_benchmarks(n_names=100000, fname_alter='_sdc_biznames.csv', n_alters=0, n_focals=10000, num_workers=1, seed=0):
+    """
+    Run all benchmarks, each in its own process (so that each reports its own memory peak).
+
+    Args:
+        n_names:        number of synthetic names to clean, and of pairs of names to match
+        fname_alter:    alter list for the end-to-end match (ignored if n_alters)
+        n_alters:       number of synthetic alter rows to generate for the end-to-end match instead
+        n_focals:       number of focal names for the end-to-end match (see perturb_rows)
+        num_workers:    number of worker processes for the end-to-end match
+        seed:           seed of all synthetic names
+
+    Return:
+        results (dict), ready to save as JSON
+    """
+    results     = dict(run=_run_info(), seed=seed, benchmarks=dict())
+    benches     = results['benchmarks']
+    alter_list  = 'synthetic' if n_alters else os.path.basename(fname_alter)
+    fname_alter = os.path.abspath(fname_alter)
+
+    # work in a scratch directory, so every benchmark starts from a cold cache and leaves no files behind
+    cwd = os.getcwd()
+    os.chdir(tempfile.mkdtemp(prefix='bizmatch-bench-'))
+    try:
+        log('Benchmark clean_name (' + str(n_names) + ' names) ...')
+        benches['clean_name'] = _in_child(bench_clean, n_names, seed)
+
+        log('Benchmark _match_names (' + str(n_names) + ' pairs) ...')
+        benches['match_names'] = _in_child(bench_pairs, n_names, seed)
+
+        if n_alters:
+            log('Generating ' + str(n_alters) + ' synthetic alter names ...')
+            fname_alter = os.path.abspath('alters.csv')
+            save_rows(synth_rows(n_alters, seed, universe=seed), fname_alter)
+        fname_focal = os.path.abspath('focals.csv')
+        save_rows(perturb_rows(fname_alter, n_focals, seed + 1), fname_focal)
+
+        log('Benchmark match_lists (' + alter_list + ', ' + str(num_workers) + ' workers) ...')
+        benches['match_lists'] = _in_child(bench_match_lists, fname_focal, fname_alter, num_workers)
+        benches['match_lists']['alter_list'] = alter_list
+    finally:
+        f_dir = os.getcwd()
+        os.chdir(cwd)
+        shutil.rmtree(f_dir, ignore_errors=True)
+
+    return results
+
+def bench_clean(n_names, seed=0):
+    """clean_name throughput, on n_names synthetic raw names"""
+    names      = [name for name, _ in synth_rows(n_names, seed)]
+    rename_dct = match._load_rename_dict()
+    return _rate(n_names, _fastest(lambda: [clean_name(name, rename_dct) for name in names]))
+
+def bench_pairs(n_pairs, seed=0):
+    """
+    _match_names throughput, on n_pairs pairs of cleaned names: half of them two ways of writing the same firm
+    (which run every test), and half of them two random firms (which mostly stop at the first char).
+    """
+    rng        = random.Random(seed)
+    rename_dct = match._load_rename_dict()
+    pairs      = []
+    for k in range(n_pairs):
+        firms = [rng.randrange(n_pairs)]
+        firms.append(firms[0] if k % 2 else rng.randrange(n_pairs))
+        pair  = []
+        for firm in firms:
+            name, day = synth_firm(firm, seed)
+            raw       = synth_name(name, rng)
+            pair     += [clean_name(raw, rename_dct), raw, day + rng.randint(-7, 7)]
+        pairs.append(pair)
+    bench   = _rate(n_pairs, _fastest(lambda: [match._match_names(*pair) for pair in pairs]))
+    results = [match._match_names(*pair) for pair in pairs]
+    bench['matched']    = sum(1 for matched, _ in results if matched)
+    bench['candidates'] = sum(1 for _, candid in results if candid)
+    return bench
+
+def bench_match_lists(fname_focal, fname_alter, num_workers=1):
+    """End-to-end match_lists of fname_focal against fname_alter (its temp files are left in the working directory)."""
+    n_focals = sum(1 for _ in fio.read_csv(fname_focal))
+    n_alters = sum(1 for _ in fio.read_csv(fname_alter))
+    start    = perf_counter()
+    match.match_lists(fname_focal, fname_alter, num_workers=num_workers)
+    bench    = _rate(n_focals, perf_counter() - start)
+    bench.update(alters=n_alters, workers=num_workers,
+                 matched=sum(1 for _ in fio.read_csv('~matched.000')),
+                 candidates=sum(1 for _ in fio.read_csv('~candidates.000')))
+    if resource and num_workers > 1: bench['workers_peak_mb'] = _peak_mb(resource.RUSAGE_CHILDREN)
+    return bench
+
+def compare_results(old, new, tolerance=BENCH_TOLERANCE):
+    """
+    Compare two sets of results (from run_benchmarks), benchmark by benchmark.
+
+    Return:
+        list of (benchmark, measure, old value, new value, ratio) for every measure that got worse by more than
+        tolerance: fewer items per second, or a higher memory peak (benchmarks run on other inputs are skipped)
+    """
+    worse = []
+    for name, new_bench in new['benchmarks'].items():
+        old_bench = old['benchmarks'].get(name)
+        if not old_bench or old.get('seed') != new.get('seed'): continue
+        if any(old_bench.get(key) != new_bench.get(key) for key in ('items', 'alters', 'alter_list', 'workers')): continue
+        for measure, higher_is_better in (('per_sec', True), ('peak_mb', False), ('workers_peak_mb', False)):
+            old_value, new_value = old_bench.get(measure), new_bench.get(measure)
+            if not old_value or not new_value: continue
+            ratio = new_value / old_value
+            if (ratio < 1 - tolerance) if higher_is_better else (ratio > 1 + tolerance):
+                worse.append((name, measure, old_value, new_value, round(ratio, 3)))
+    return worse
+
+def _in_child(fn, *args):
+    """Run a benchmark in a forked child process (where fork is available), with the memory peak of that process."""
+    if 'fork' not in mp.get_all_start_methods(): return _measured(fn, args)
+    ctx              = mp.get_context('fork')
+    receiver, sender = ctx.Pipe(duplex=False)
+    child            = ctx.Process(target=_child, args=(sender, fn, args))   # not a pool: it may need a pool itself
+    child.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = RuntimeError(fn.__name__ + ' died')
+    child.join()
+    if isinstance(result, BaseException): raise result
+    return result
+
+def _child(sender, fn, args):
+    try:
+        result = _measured(fn, args)
+    except BaseException as e:
+        result = RuntimeError(fn.__name__ + ': ' + repr(e))
+    sender.send(result)
+
+def _measured(fn, args):
+    base  = _peak_mb()
+    bench = fn(*args)
+    if resource: bench.update(peak_mb=_peak_mb(), base_mb=base)   # base: inherited from the parent on fork
+    return bench
+
+def _peak_mb(who=None):
+    """Peak resident memory (MB) of this process (or of its largest child process) so far"""
+    if not resource: return None
+    kb = resource.getrusage(resource.RUSAGE_SELF if who is None else who).ru_maxrss
+    return round(kb / (1 << 20 if platform.system() == 'Darwin' else 1 << 10), 1)   # bytes on macOS, KB elsewhere
+
+def _fastest(fn, repeat=BENCH_REPEAT):
+    """Fastest time (seconds) of repeat calls to fn"""
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        fn()
+        times.append(perf_counter() - start)
+    return min(times)
+
+def _rate(items, seconds):
+    return dict(items=items, seconds=round(seconds, 4), per_sec=round(items / seconds, 1) if seconds else None)
+
+def _run_info():
+    """What a run was measured on: code version, libraries, host and settings."""
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = ''
+    return dict(date=datetime.now().isoformat(timespec='seconds'), commit=commit, config=CONFIG_FINGERPRINT,
+                python=platform.python_version(), numpy=np.__version__, levenshtein=Levenshtein.__version__,
+                platform=platform.platform(), cpus=os.cpu_count(),
+                settings=dict(MATCH_ENGINE=MATCH_ENGINE, INDEX_MIN_VISIT=INDEX_MIN_VISIT, CANDID_DIFF=CANDID_DIFF,
+                              CANDID_THRESHOLD=CANDID_THRESHOLD, CANDID_TOP_K=CANDID_TOP_K,
+                              ALLOW_ONE_2_MANY=ALLOW_ONE_2_MANY, ALLOW_DAYS_BEFORE=ALLOW_DAYS_BEFORE,
+                              ALLOW_DAYS_AFTER=ALLOW_DAYS_AFTER, WORKER_CHUNK_SIZE=WORKER_CHUNK_SIZE,
+                              USE_CACHE=USE_CACHE, PROFILE=PROFILE))
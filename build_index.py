@@ -0,0 +1,18 @@
+"""
+    Prebuild the index of an alter list, so every later match against it can memory-map
+    the index instead of cleaning the alter list again.
+
+    MUST be run from the Command Line - not meant for importing!
+
+    Args:
+        argv[1] = file name of alter list   (index is saved next to it, with INDEX_EXT appended)
+
+"""
+
+if __name__ == "__main__":
+    from   sys import argv
+    import match
+
+    fname_alter = str(argv[1])
+
+    match.build_index(fname_alter)
@@ -4,6 +4,10 @@
 
 import fio
 import Levenshtein
+import numpy as np
+from heapq      import heappop, heappush, nsmallest
+from rapidfuzz  import process as rf_process
+from rapidfuzz  import distance as rf_distance
 from support    import *
 from   settings import *
 
@@ -25,6 +29,91 @@ REPLACE     = fio.load_csv(PATH_CONFIG_FILES + F_REPLACE,      default_no_file=T
 SKIP        = fio.load_set(PATH_CONFIG_FILES + F_SKIP,         default_no_file=True, freeze=True)
 STEM        = fio.load_set(PATH_CONFIG_FILES + F_STEM,         default_no_file=True, freeze=True)
 
+# fingerprint of everything that decides how a name gets cleaned (the config files and this module)
+CONFIG_FINGERPRINT = fio.hash_keys(
+        [fio.hash_file(PATH_CONFIG_FILES + f, default_no_file=True)
+         for f in (F_BRANDNAMES, F_CORPSUFFIXES, F_RENAME, F_REPLACE, F_SKIP, F_STEM)] +
+        [fio.hash_file(__file__)])
+
+_MASK_CHARS     = 'abcdefghijklmnopqrstuvwxyz0123456789 '   # chars with their own bit in char_mask()
+_CHAR_BITS      = {c: 1 << i for i, c in enumerate(_MASK_CHARS)}
+MASK_EXACT_BITS = len(_MASK_CHARS)
+
+
+# COMPILE CONFIG -------------------------------------------------------------------------------------------------------
+
+def compile_replace(rows):
+    """
+    Index REPLACE rows on the first term of their phrase, so that cleaning a name only visits the
+    rows its own terms (or the replacements made along the way) can trigger.
+
+    Return:
+        list of (padded phrase, padded replacement, terms of replacement) and
+        dict of first term of phrase -> row numbers (in file order)
+    """
+    rules = list()
+    index = dict()
+    for i, (old, new) in enumerate(rows):
+        rules.append((' ' + old + ' ', ' ' + new + ' ', new.split(' ')))
+        index.setdefault(old.split(' ')[0], []).append(i)
+    return rules, index
+
+def replace_phrases(name, compiled=None):
+    """Replace phrases BY PHRASE, same as applying every REPLACE row to the name in file order."""
+    rules, index = compiled or REPLACE_RULES
+
+    todo = set()
+    for term in name.split(' '):
+        todo.update(index.get(term, ()))
+    if not todo: return name.strip()
+
+    # apply triggered rows in file order; a replacement can trigger later rows
+    heap = sorted(todo)
+    name = ' ' + name + ' '
+    while heap:
+        i = heappop(heap)
+        old, new, new_terms = rules[i]
+        if old in name:
+            name = name.replace(old, new)
+            for term in new_terms:
+                for j in index.get(term, ()):
+                    if j > i and j not in todo:
+                        todo.add(j)
+                        heappush(heap, j)
+    return name.strip()
+
+def compile_brands(brands):
+    """
+    Index BRANDNAMES on their first term (a brand may have several terms).
+
+    Return:
+        dict of first term -> list of (brand terms, brand), brands with more terms first
+    """
+    index = dict()
+    for brand in sorted(brands, key=lambda b: (-len(b.split(' ')), b)):
+        if brand: index.setdefault(brand.split(' ')[0], []).append((brand.split(' '), brand))
+    return index
+
+def compile_stems(stems):
+    """
+    Build a prefix trie from STEM.
+
+    Return:
+        nested dict of char -> node, where a node's None key holds the stem ending at that node
+    """
+    trie = dict()
+    for stem in stems:
+        if not stem: continue
+        node = trie
+        for c in stem:
+            node = node.setdefault(c, dict())
+        node[None] = stem
+    return trie
+
+REPLACE_RULES = compile_replace(REPLACE)
+BRAND_INDEX   = compile_brands(BRANDNAMES)
+STEM_TRIE     = compile_stems(STEM)
+
 
 # MAIN COMPARISON FUNCTION ---------------------------------------------------------------------------------------------
 
@@ -61,16 +150,14 @@ def compare_biznames(bizname1, bizname2, fuzzy_diff=0, fuzzy_ratio=0.9, debug=Fa
         return False
 
     # check num of different unique chars
-    f_chars = {c for c in f1_clean}
-    a_chars = {c for c in f2_clean}
-    common = f_chars.intersection(a_chars)
-    n_diff = abs(max(len(f_chars), len(a_chars)) - len(common))
+    n_diff = calc_char_diff(f1_clean, f2_clean)
     if debug: print('n_diff', n_diff)
 
     if n_diff <= fuzzy_diff:
 
-        # calc dist now (late) to save runtime
-        dist = calc_distance(f1_clean, f2_clean)
+        # calc dist now (late) to save runtime, and stop once it cannot pass fuzzy_ratio
+        max_dist = max_distance(len(f1_clean), len(f2_clean), fuzzy_ratio)
+        dist     = calc_distance(f1_clean, f2_clean, max_dist)
 
         # EXACT MATCH
         if dist == 0:
@@ -79,20 +166,87 @@ def compare_biznames(bizname1, bizname2, fuzzy_diff=0, fuzzy_ratio=0.9, debug=Fa
         # GOOD ENOUGH MATCH?
         else:
 
-            # calc % of name that is similar
-            ratio = 1 - (float(dist) /
-                         min(len(f1_clean), len(f2_clean)))
+            if debug: print('dist', dist, 'max_dist', max_dist)
 
-            if debug: print('ratio', ratio)
-
-            # CANDIDATE
-            if ratio > fuzzy_ratio:
+            # CANDIDATE (same as: 1 - dist / min length > fuzzy_ratio)
+            if dist <= max_dist:
                 return True
 
     return False
 
+def compare_many(pairs, fuzzy_diff=0, fuzzy_ratio=0.9):
+    """
+        Compare many pairs of business names at once (same results as compare_biznames on each pair)
+
+        Each distinct name gets cleaned only once, and each first name gets scored against all of
+        its second names (that pass the prefilters) in a single call.
+
+        Args:
+                pairs:                  iterable of (first business name, second business name)
+                fuzzy_diff:             when doing a fuzzy match, max allowed difference in length of names
+                fuzzy_ratio:            when doing a fuzzy match, max levenstein difference ratio allowed between names
+
+        Return:
+                list of booleans, one per pair
+    """
+
+    pairs   = list(pairs)
+    cleaned = {name: clean_name(name) for name in set(name for pair in pairs for name in pair)}
+    results = [False] * len(pairs)
+
+    # group pairs that pass the prefilters on their first (clean) name
+    groups = dict()
+    for p, (bizname1, bizname2) in enumerate(pairs):
+        f1_clean, f2_clean = cleaned[bizname1], cleaned[bizname2]
+        if _passes_prefilters(f1_clean, f2_clean, fuzzy_diff):
+            groups.setdefault(f1_clean, []).append((p, f2_clean))
+
+    # score each group in one call
+    for f1_clean, group in groups.items():
+        max_dists = [max_distance(len(f1_clean), len(f2_clean), fuzzy_ratio) for _, f2_clean in group]
+        dists     = calc_distances(f1_clean, [f2_clean for _, f2_clean in group], max(max_dists))
+        for (p, _), dist, max_dist in zip(group, dists, max_dists):
+            results[p] = bool(dist <= max_dist)
+
+    return results
+
+def best_matches(name, candidates, k=1, fuzzy_diff=0, fuzzy_ratio=0.9):
+    """
+        Best matches for a business name among candidate names
+
+        Args:
+                name:                   business name
+                candidates:             candidate business names
+                k:                      max number of matches to return
+                fuzzy_diff:             when doing a fuzzy match, max allowed difference in length of names
+                fuzzy_ratio:            when doing a fuzzy match, max levenstein difference ratio allowed between names
+
+        Return:
+                up to k of (candidate, ratio) for the candidates that compare_biznames accepts, where
+                ratio = 1 - dist / min length; highest ratio first (ties in order of candidates)
+    """
+
+    candidates = list(candidates)
+    f1_clean   = clean_name(name)
+    cleaned    = {c: clean_name(c) for c in set(candidates)}
+
+    keep = [(i, cleaned[c]) for i, c in enumerate(candidates) if _passes_prefilters(f1_clean, cleaned[c], fuzzy_diff)]
+    if not keep: return []
+
+    max_dists = [max_distance(len(f1_clean), len(f2_clean), fuzzy_ratio) for _, f2_clean in keep]
+    dists     = calc_distances(f1_clean, [f2_clean for _, f2_clean in keep], max(max_dists))
+    scored    = [(1 - float(dist) / min(len(f1_clean), len(f2_clean)), i)
+                 for (i, f2_clean), dist, max_dist in zip(keep, dists, max_dists) if dist <= max_dist]
+    return [(candidates[i], ratio) for ratio, i in nsmallest(k, scored, key=lambda s: (-s[0], s[1]))]
+
+def _passes_prefilters(f1_clean, f2_clean, fuzzy_diff):
+    """The tests compare_biznames runs before calculating the distance (non-empty, first char, length, unique chars)"""
+    return (bool(f1_clean) and bool(f2_clean) and f1_clean[0] == f2_clean[0] and
+            abs(len(f1_clean) - len(f2_clean)) <= fuzzy_diff and calc_char_diff(f1_clean, f2_clean) <= fuzzy_diff)
+
 # CLEANING FUNCTIONS ---------------------------------------------------------------------------------------------------
 
+@profiled('clean_name')
 def clean_name(name, rename_dct=None):
 
     # fast exit
@@ -106,12 +260,7 @@ def clean_name(name, rename_dct=None):
     if name in SKIP: return ''
 
     # replacements (pass # 1)
-    for (old, new) in REPLACE:
-        old = " " + old + " "
-        new = " " + new + " "
-        name = str(" " + name + " ")
-        name = name.replace(old, new)
-    name = name.strip()
+    name = replace_phrases(name)
     if name in SKIP: return ''
     if not name: return ''
 
@@ -126,14 +275,7 @@ def clean_name(name, rename_dct=None):
     if not name: return ''
 
     # stem
-    terms = name.split()
-    for i in range(len(terms)):
-        term = terms[i]
-        for stem in STEM:
-            if term.startswith(stem):
-                terms[i] = stem
-
-    name = ' '.join(terms)
+    name = ' '.join([get_stem(term) for term in name.split()])
     if name in SKIP: return ''
     if not name: return ''
 
@@ -149,12 +291,7 @@ def clean_name(name, rename_dct=None):
     if not name: return ''
 
     # synonyms (pass # 2)
-    for (old, new) in REPLACE:
-        old = " " + old + " "
-        new = " " + new + " "
-        name = str(" " + name + " ")
-        name = name.replace(old, new)
-    name = name.strip()
+    name = replace_phrases(name)
     if name in SKIP: return ''
     if not name: return ''
 
@@ -178,12 +315,29 @@ def clean_name(name, rename_dct=None):
     return name
 
 def get_brandname(name):
-    s = " " + name + " "
-    for brand in BRANDNAMES:
-        if s.find(" " + brand + " ") >= 0:
-            return brand
+    """
+    Roll a name up to a brand that appears in it (as whole terms).
+
+    If several brands appear, the brand starting on the earliest term of the name wins;
+    if several start on the same term, the brand with the most terms wins.
+    """
+    terms = name.split(' ')
+    for i, term in enumerate(terms):
+        for brand_terms, brand in BRAND_INDEX.get(term, ()):
+            if terms[i:i + len(brand_terms)] == brand_terms:
+                return brand
     return name
 
+def get_stem(term):
+    """Longest stem in STEM that the term starts with (or the term itself if none)."""
+    node = STEM_TRIE
+    stem = term
+    for c in term:
+        node = node.get(c)
+        if node is None: break
+        stem = node.get(None, stem)
+    return stem
+
 def remove_punct(s):
 
     # Change to a SPACE
@@ -200,7 +354,13 @@ def remove_punct(s):
 
     return s
 
-def calc_distance(name1, name2):
+def calc_distance(name1, name2, max_dist=None):
+    """
+    Levenshtein distance between two names.
+
+    With max_dist, the calculation stops as soon as the distance is known to exceed max_dist
+    and returns max_dist + 1 instead of the full distance.
+    """
 
     assert name1, 'No name1'
     assert name2, 'No name2'
@@ -210,8 +370,71 @@ def calc_distance(name1, name2):
         return 0
 
     # calc levenshtein
-    else:
+    elif max_dist is None:
         return Levenshtein.distance(name1, name2)
+    else:
+        return Levenshtein.distance(name1, name2, score_cutoff=max_dist)
+
+def calc_distances(name, names, max_dist=None):
+    """
+    Levenshtein distance from one name to each of many names, in a single call.
+
+    Return:
+        NumPy array of distances, in the order of names (with max_dist, any distance
+        above max_dist comes back as max_dist + 1)
+    """
+    if not len(names): return np.zeros(0, dtype=np.int32)
+    return rf_process.cdist([name], names, scorer=rf_distance.Levenshtein.distance,
+                            score_cutoff=max_dist, dtype=np.int32)[0]
+
+def max_distance(len1, len2, threshold):
+    """Largest distance (but at least 0) for which 1 - dist / min(len1, len2) > threshold."""
+    min_len = min(len1, len2)
+    dist    = int((1 - threshold) * min_len) + 1
+    while dist > 0 and not 1 - (float(dist) / min_len) > threshold:
+        dist -= 1
+    return max(dist, 0)   # thresholds of 1 or more let no distance pass, so the loop ends below 0
+
+def calc_char_diff(name1, name2):
+    """Number of unique chars in the larger char set of two names that the other name does not share."""
+
+    m1 = char_mask(name1)
+    m2 = char_mask(name2)
+
+    # bitmasks are exact when no char was folded
+    if not (m1 | m2) >> MASK_EXACT_BITS:
+        common = popcount_int(m1 & m2)
+        return max(popcount_int(m1), popcount_int(m2)) - common
+
+    # otherwise count on sets
+    chars1 = {c for c in name1}
+    chars2 = {c for c in name2}
+    common = chars1.intersection(chars2)
+    return abs(max(len(chars1), len(chars2)) - len(common))
+
+def char_mask(name):
+    """
+    Fixed-width (64 bit) bitmask of the unique chars in a name.
+
+    Letters, digits and space get their own bit; any other char is folded onto one of the
+    remaining bits. Folding can only lower the char diff counted on the masks, so a mask
+    test never rejects a pair that the exact set test would keep.
+    """
+    mask = 0
+    for c in set(name):
+        mask |= _CHAR_BITS.get(c) or 1 << (MASK_EXACT_BITS + ord(c) % (64 - MASK_EXACT_BITS))
+    return mask
+
+def popcount_int(mask):
+    return bin(mask).count('1')
+
+if hasattr(np, 'bitwise_count'):
+    popcount = np.bitwise_count
+else:
+    _POPCOUNT8 = np.array([popcount_int(i) for i in range(256)], dtype=np.uint8)
+    def popcount(masks):
+        masks = np.asarray(masks, dtype=np.uint64)
+        return _POPCOUNT8[masks.view(np.uint8)].reshape(masks.shape + (8,)).sum(axis=-1, dtype=np.uint8)
 
 def is_number(s):
     try:    float(s)
@@ -4,7 +4,10 @@
 
 import os
 import csv
+import json
+import hashlib
 import subprocess
+from contextlib import contextmanager
 
 
 # LOAD -------------------------------------------------------------------------
@@ -70,6 +73,16 @@ def load_str(fname, default_no_file=False):
         txt = f.read()
     return txt
 
+def load_json(fname, default_no_file=False):
+    fname = str(fname.strip())
+    if not os.path.exists(fname):
+        if default_no_file:
+            return None
+        else:
+            raise IOError
+    with open(fname, mode='r', encoding='utf-8') as f:   # read-only
+        return json.load(f)
+
 def load_csv(fname, quote=None, default_no_file=False):
     fname = str(fname.strip())
     if not os.path.exists(fname):
@@ -121,6 +134,27 @@ def save_csv(lst, fname):
         writer = csv.writer(f, dialect='excel')
         writer.writerows(lst)
 
+@contextmanager
+def open_atomic(fname, mode='w', ftmp=''):
+    """
+    Open a temp file (ftmp, else fname.tmp) to write fname with, and move it in place of fname once
+    written, atomically: a crash mid-write leaves the previous file intact, and readers never see half
+    a file. The temp file is deleted if writing stops on an error.
+    """
+    fname = str(fname.strip())
+    ftmp  = ftmp or fname + '.tmp'
+    try:
+        with open(ftmp, mode, encoding=None if 'b' in mode else 'utf-8') as f:
+            yield f
+        os.replace(ftmp, fname)
+    finally:
+        if os.path.exists(ftmp): os.remove(ftmp)
+
+def save_json(obj, fname):
+    """Save obj as JSON (atomically, see open_atomic)"""
+    with open_atomic(fname) as f:
+        json.dump(obj, f)
+
 def save_dct(dct, fname):
     fname = str(fname.strip())
     if os.path.exists(fname): os.remove(fname)
@@ -185,6 +219,35 @@ def gs_list_bucket(bucket_name):
 
 # MISC -------------------------------------------------------------------------
 
+def hash_file(fname, default_no_file=False, size=None):
+    """SHA1 hex digest of a file's contents (only its first size bytes, if given)"""
+    fname = str(fname.strip())
+    if not os.path.exists(fname):
+        if default_no_file:
+            return ''
+        else:
+            raise IOError
+    return hash_prefixes(fname, [size])[0]
+
+def hash_prefixes(fname, sizes):
+    """SHA1 hex digests of the first size bytes of a file (all of it for None), for each of sizes (ascending), in one pass"""
+    h       = hashlib.sha1()
+    digests = []
+    with open(fname, 'rb') as f:
+        at = 0
+        for size in sizes:
+            while size is None or at < size:
+                chunk = f.read(1 << 20 if size is None else min(size - at, 1 << 20))
+                if not chunk: break
+                h.update(chunk)
+                at += len(chunk)
+            digests.append(h.hexdigest())
+    return digests
+
+def hash_keys(keys):
+    """SHA1 hex digest of a list of keys (str), e.g. to tell if any of what decides a saved file has changed"""
+    return hashlib.sha1(' '.join(keys).encode()).hexdigest()
+
 def list_fnames(dirpath=''):
     """Walk directory and gather list of filenames"""
     if not dirpath: dirpath='.'
@@ -0,0 +1,446 @@
+"""
+    Index an alter list of business names for matching
+"""
+
+import fio
+import json
+import mmap
+import zlib
+import Levenshtein
+import numpy as np
+from array      import array
+from compare    import *
+from settings   import *
+
+INDEX_FINGERPRINT = fio.hash_file(__file__)   # index files saved by any other version of this code are out of date
+
+
+# COLUMNAR ALTER INDEX -------------------------------------------------------------------------------------------------
+
+def index_alters(a_rows, engine=MATCH_ENGINE):
+    """
+    Build a compact, columnar index of an alter list.
+
+    Alters with both a cleaned and a raw name get sorted into blocks on (first char, length of
+    cleaned name), the first two tests in match._match_names. Within a block, the dated alters
+    come first (sorted on date) and the undated ones after. Alters with the same cleaned name
+    and date (or both undated) share one position, so they are matched only once. Each column
+    is a NumPy array, in block order (of positions) unless noted otherwise:
+
+        member_offsets  int64   where the row numbers of each position start in members (plus where the last end)
+        members         int32   row numbers (in the alter list) of the alters at each position, ascending
+        names           uint8   cleaned names (UTF-8) back to back, see alter_name()
+        name_offsets    int64   where each cleaned name starts in names (plus where the last one ends)
+        raws            uint8   raw names (UTF-8) back to back, in ROW order, see alter_raw()
+        raw_offsets     int64   where each raw name starts in raws (plus where the last one ends), in ROW order
+        dates           int32   date ordinal (0 if undated)
+        lengths         int16   length of cleaned name
+        firsts          int32   first char of cleaned name (as a code point)
+        masks           uint64  char mask of cleaned name, see compare.char_mask()
+        n_chars         int16   number of unique chars in cleaned name
+        exact_keys      int64   sorted unique keys of the cleaned names, see name_key()
+        exact_offsets   int64   where the positions of each key start in exact_rows (plus where the last end)
+        exact_rows      int32   positions of the alters with each key, ascending per key
+
+    The exact_ columns map each cleaned name to its positions, see exact_matches(). On top of
+    that, the 'ngram' engine adds a trigram inverted index, see index_grams(); the 'bktree'
+    engine adds a BK-tree per block, see index_bktrees(); the 'symspell' engine adds a map of
+    delete variants, see index_deletes().
+
+    Args:
+        a_rows:     iterable of (clean name, raw name, date ordinal or None)
+        engine:     matching engine to index for (see MATCH_ENGINE in settings.py)
+
+    Return:
+        dict of column name -> array, plus 'blocks': dict of (first char, length) -> (start, split, stop)
+        where [start, split) holds the dated alters of the block and [split, stop) the undated ones,
+        and 'engine'
+    """
+
+    # alters that share a cleaned name and date share a position (raw names stay in row order)
+    groups      = dict()   # (clean name, date ordinal) -> row numbers
+    raws        = bytearray()
+    raw_offsets = array('q', [0])
+    for i, (a_clean, a_raw, a_date) in enumerate(a_rows):
+        if a_clean and a_raw: groups.setdefault((a_clean, a_date or 0), []).append(i)
+        raws += a_raw.encode('utf-8')
+        raw_offsets.append(len(raws))
+
+    # block order
+    order  = sorted(groups, key=lambda key: (key[0][0], len(key[0]), not key[1], key[1]))
+    cleans = [a_clean for a_clean, _ in order]
+
+    blocks = dict()
+    for j, (a_clean, a_date) in enumerate(order):
+        key = (a_clean[0], len(a_clean))
+        if key not in blocks: blocks[key] = [j, j, j]
+        blocks[key][2] = j + 1
+        if a_date: blocks[key][1] = j + 1
+
+    names = [a_clean.encode('utf-8') for a_clean in cleans]
+    masks = np.array([char_mask(a_clean) for a_clean in cleans], dtype=np.uint64)
+
+    a_idx = dict(
+        member_offsets = np.cumsum([0] + [len(groups[key]) for key in order], dtype=np.int64),
+        members        = np.array([i for key in order for i in groups[key]], dtype=np.int32),
+        names          = np.frombuffer(b''.join(names), dtype=np.uint8),
+        name_offsets   = np.cumsum([0] + [len(name) for name in names], dtype=np.int64),
+        raws           = np.frombuffer(bytes(raws), dtype=np.uint8),
+        raw_offsets    = np.array(raw_offsets, dtype=np.int64),
+        dates          = np.array([a_date for _, a_date in order], dtype=np.int32),
+        lengths        = np.array([len(a_clean) for a_clean in cleans], dtype=np.int16),
+        firsts         = np.array([ord(a_clean[0]) for a_clean in cleans], dtype=np.int32),
+        masks          = masks,
+        n_chars        = popcount(masks).astype(np.int16),
+        blocks         = {key: tuple(block) for key, block in blocks.items()},
+        engine         = engine)
+
+    a_idx.update(_postings([name_key(a_clean) for a_clean in cleans], range(len(cleans)), 'exact_'))
+    if engine == 'ngram':    a_idx.update(index_grams(cleans))
+    if engine == 'bktree':   a_idx.update(index_bktrees(cleans, a_idx['blocks']))
+    if engine == 'symspell': a_idx.update(index_deletes(cleans))
+    return a_idx
+
+def alter_rows(a_idx, positions):
+    """Row numbers (in the alter list) of all the alters at positions, position by position"""
+    return gather(a_idx['member_offsets'], a_idx['members'], positions)
+
+def gather(offsets, values, items):
+    """values[offsets[k]:offsets[k + 1]] for each k in items, concatenated (for columns stored as offsets + values)"""
+    items  = np.asarray(items, dtype=np.int64)
+    starts = offsets[items]
+    n      = offsets[items + 1] - starts
+    return values[np.arange(n.sum()) + np.repeat(starts - np.cumsum(n) + n, n)]
+
+def alter_name(a_idx, j):
+    """Cleaned name of the alter at position j (in block order)"""
+    offsets = a_idx['name_offsets']
+    return a_idx['names'][offsets[j]:offsets[j + 1]].tobytes().decode('utf-8')
+
+def alter_names(a_idx, positions):
+    """Cleaned names of the alters at (ascending) positions, decoding their whole span at once if it is all ASCII"""
+    if not len(positions): return []
+    offsets = a_idx['name_offsets']
+    starts  = offsets[positions].tolist()
+    stops   = offsets[np.asarray(positions) + 1].tolist()
+    text    = a_idx['names'][starts[0]:stops[-1]].tobytes().decode('utf-8')
+    if len(text) != stops[-1] - starts[0]: return [alter_name(a_idx, j) for j in positions]
+    return [text[start - starts[0]:stop - starts[0]] for start, stop in zip(starts, stops)]
+
+def alter_raw(a_idx, row):
+    """Raw name of the alter in row number row (of the alter list)"""
+    offsets = a_idx['raw_offsets']
+    return a_idx['raws'][offsets[row]:offsets[row + 1]].tobytes().decode('utf-8')
+
+def index_rows(a_idx):
+    """
+    The rows an alter index was built from, e.g. to index them again together with more rows.
+
+    Return:
+        generator of (clean name, raw name, date ordinal or None), in row order (rows that
+        had no cleaned name come back with an empty one)
+    """
+    n_rows  = len(a_idx['raw_offsets']) - 1
+    cleans  = [''] * n_rows
+    dates   = [None] * n_rows
+    members = a_idx['members'].tolist()
+    offsets = a_idx['member_offsets'].tolist()
+    for j, a_date in enumerate(a_idx['dates'].tolist()):
+        a_clean = alter_name(a_idx, j)
+        for i in members[offsets[j]:offsets[j + 1]]:
+            cleans[i], dates[i] = a_clean, a_date or None
+    for i in range(n_rows):
+        yield cleans[i], alter_raw(a_idx, i), dates[i]
+
+def block_ranges(a_idx, block, f_date, days_before=ALLOW_DAYS_BEFORE, days_after=ALLOW_DAYS_AFTER):
+    """
+    Ranges of a block that a focal has to visit: the dated alters inside its date window
+    (all of them if the focal is undated), then all the undated alters.
+    """
+    start, split, stop = block
+    if f_date:
+        dates = a_idx['dates'][start:split]
+        lo    = start + int(dates.searchsorted(f_date - days_before, 'left'))
+        hi    = start + int(dates.searchsorted(f_date + days_after,  'right'))
+    else:
+        lo, hi = start, split
+    return (lo, hi), (split, stop)
+
+def exact_matches(a_idx, name, lo, hi):
+    """Positions in [lo, hi) of the alters with exactly this cleaned name (ascending)"""
+    parts = _probe(a_idx, 'exact_', [name_key(name)], lo, hi)
+    if not parts: return np.zeros(0, dtype=np.int32)
+    return np.array([j for j in parts[0].tolist() if alter_name(a_idx, j) == name], dtype=np.int32)
+
+def name_key(name):
+    """63-bit hash key of a name (crc32 and adler32 of its UTF-8)"""
+    name = name.encode('utf-8')
+    return zlib.crc32(name) << 31 | zlib.adler32(name) >> 1
+
+
+# TRIGRAM INDEX --------------------------------------------------------------------------------------------------------
+
+def index_grams(names):
+    """
+    Inverted index from the trigrams of cleaned names to their positions (in block order).
+
+    Each gram is keyed together with its occurrence number in the name (see gram_keys), so
+    counting shared keys counts the multiset of shared trigrams. Columns:
+
+        gram_keys       int64   sorted unique keys
+        gram_offsets    int64   where the positions of each key start in gram_rows (plus where the last end)
+        gram_rows       int32   positions of the names holding each key, ascending per key
+    """
+    keys = array('q')
+    rows = array('i')
+    for j, name in enumerate(names):
+        name_keys = gram_keys(name)
+        keys.extend(name_keys)
+        rows.extend([j] * len(name_keys))
+    return _postings(keys, rows, 'gram_')
+
+def gram_keys(name):
+    """
+    Keys of the trigrams of a name, padded with two blanks on each end (len(name) + 2 of them).
+
+    Chars are folded to 16 bits and the occurrence number of the gram goes in the low 15 bits.
+    Folding can only merge grams, which only raises the count of shared keys.
+    """
+    padded = '\0\0' + name + '\0\0'
+    seen   = dict()
+    keys   = list()
+    for i in range(len(name) + 2):
+        gram = (ord(padded[i]) & 0xFFFF) << 32 | (ord(padded[i + 1]) & 0xFFFF) << 16 | (ord(padded[i + 2]) & 0xFFFF)
+        occ  = seen[gram] = seen.get(gram, -1) + 1
+        keys.append(gram << 15 | occ)
+    return keys
+
+def shared_grams(a_idx, name, lo, hi):
+    """
+    Number of trigram keys a name shares with each alter in positions [lo, hi).
+
+    Return:
+        array of counts, one per position from lo to hi
+    """
+    parts = _probe(a_idx, 'gram_', gram_keys(name), lo, hi)
+    if not parts: return np.zeros(hi - lo, dtype=np.int64)
+    return np.bincount(np.concatenate(parts) - lo, minlength=hi - lo)
+
+def min_shared_grams(len1, len2, max_dist):
+    """
+    Fewest trigrams (of the padded names) two names must share to be within max_dist edits:
+    each edit breaks at most 3 of the max(len1, len2) + 2 grams of the longer name.
+    """
+    return max(len1, len2) + 2 - 3 * max_dist
+
+def _postings(keys, rows, prefix):
+    """Inverted index columns (prefix + keys / offsets / rows) from parallel arrays of keys and the rows holding them."""
+    keys  = np.array(keys, dtype=np.int64)
+    order = np.argsort(keys, kind='stable')   # stable, so rows stay ascending per key
+    keys  = keys[order]
+    uniq  = np.flatnonzero(np.diff(keys, prepend=-1)) if len(keys) else np.zeros(0, dtype=np.int64)
+    return {prefix + 'keys':    keys[uniq],
+            prefix + 'offsets': np.append(uniq, len(keys)).astype(np.int64),
+            prefix + 'rows':    np.array(rows, dtype=np.int32)[order]}
+
+def _probe(a_idx, prefix, keys, lo, hi):
+    """Rows in [lo, hi) under each of keys (that is in the inverted index), as a list of arrays."""
+    keys    = np.array(keys, dtype=np.int64)
+    i_keys  = a_idx[prefix + 'keys']
+    offsets = a_idx[prefix + 'offsets']
+    rows    = a_idx[prefix + 'rows']
+    parts   = list()
+    if len(i_keys):
+        found = np.minimum(i_keys.searchsorted(keys), len(i_keys) - 1)
+        for k in found[i_keys[found] == keys]:
+            posts = rows[offsets[k]:offsets[k + 1]]
+            parts.append(posts[posts.searchsorted(lo):posts.searchsorted(hi)])
+    return parts
+
+
+# SYMMETRIC DELETES ----------------------------------------------------------------------------------------------------
+
+def index_deletes(names, max_dist=SYMSPELL_DISTANCE, threshold=CANDID_THRESHOLD):
+    """
+    Map from the delete variants of short cleaned names (names in block order) to their positions.
+
+    Two names within max_dist edits of each other share a variant with at most max_dist chars
+    deleted from each, so probing the variants of a focal name finds every alter within max_dist.
+    Only names short enough for max_distance() to stay within max_dist are indexed, since longer
+    names would need more deletes than they are worth (and they get scanned instead). Columns:
+
+        sym_params      int32   [max_dist, longest name indexed]
+        sym_keys        int64   sorted unique keys of the variants, see delete_keys()
+        sym_offsets     int64   where the positions of each key start in sym_rows (plus where the last end)
+        sym_rows        int32   positions of the names with each variant, ascending per key
+    """
+    max_len = 0
+    while max_len < 255 and max_distance(max_len + 1, max_len + 1, threshold) <= max_dist:
+        max_len += 1
+    keys = array('q')
+    rows = array('i')
+    for j, name in enumerate(names):
+        if len(name) > max_len: continue
+        name_keys = delete_keys(name, max_dist)
+        keys.extend(name_keys)
+        rows.extend([j] * len(name_keys))
+    return dict(sym_params=np.array([max_dist, max_len], dtype=np.int32), **_postings(keys, rows, 'sym_'))
+
+def delete_keys(name, max_dist):
+    """
+    Keys of all variants of name with up to max_dist chars deleted. Keys that collide only add
+    alters to verify, never drop any.
+    """
+    variants = {name}
+    level    = {name}
+    for _ in range(max_dist):
+        level     = {v[:i] + v[i + 1:] for v in level for i in range(len(v))}
+        variants |= level
+    return [name_key(v) for v in variants]
+
+def shared_deletes(a_idx, name, lo, hi):
+    """Positions in [lo, hi) of the alters that share a delete variant with name (sorted)."""
+    parts = _probe(a_idx, 'sym_', delete_keys(name, int(a_idx['sym_params'][0])), lo, hi)
+    if not parts: return np.zeros(0, dtype=np.int32)
+    return np.unique(np.concatenate(parts))
+
+
+# BK-TREES -------------------------------------------------------------------------------------------------------------
+
+def index_bktrees(names, blocks):
+    """
+    A BK-tree over the unique cleaned names of each block (names in block order).
+
+    Every child of a node sits at a known edit distance from it, so a search only has to descend
+    into the children whose distance is within the search radius of the node's own distance
+    (the triangle inequality). The trees are flattened into columns:
+
+        bk_block_starts     int32   start of each block (sorted)
+        bk_block_roots      int32   root node of the tree of each block
+        bk_member_offsets   int64   where the positions of each node start in bk_members (plus where the last end)
+        bk_members          int32   positions of the alters that share the name of each node (first one names it)
+        bk_child_offsets    int64   where the children of each node start (plus where the last end)
+        bk_child_dists      int16   distance from each node to each child, ascending per node
+        bk_child_nodes      int32   child nodes
+    """
+    starts   = list()
+    roots    = list()
+    members  = list()
+    children = list()
+    for start, _, stop in sorted(blocks.values()):
+        root  = len(members)
+        nodes = dict()   # name -> node
+        starts.append(start)
+        roots.append(root)
+        for j in range(start, stop):
+            name = names[j]
+            if name in nodes:
+                members[nodes[name]].append(j)
+                continue
+            node = len(members)
+            if nodes:
+                parent = root
+                while True:
+                    d = Levenshtein.distance(name, names[members[parent][0]])
+                    if d not in children[parent]: break
+                    parent = children[parent][d]
+                children[parent][d] = node
+            nodes[name] = node
+            members.append([j])
+            children.append(dict())
+
+    child_lists = [sorted(kids.items()) for kids in children]
+    return dict(bk_block_starts   = np.array(starts, dtype=np.int32),
+                bk_block_roots    = np.array(roots, dtype=np.int32),
+                bk_member_offsets = np.cumsum([0] + [len(m) for m in members], dtype=np.int64),
+                bk_members        = np.array([j for m in members for j in m], dtype=np.int32),
+                bk_child_offsets  = np.cumsum([0] + [len(kids) for kids in child_lists], dtype=np.int64),
+                bk_child_dists    = np.array([d for kids in child_lists for d, _ in kids], dtype=np.int16),
+                bk_child_nodes    = np.array([node for kids in child_lists for _, node in kids], dtype=np.int32))
+
+def bk_search(a_idx, name, block, radius):
+    """
+    Alters of a block within radius (edit distance) of name, from the block's BK-tree.
+    The tree is searched a level at a time, scoring each level in one call.
+
+    Return:
+        (positions, distances) of the alters found, sorted on position
+    """
+    m_offsets, members = a_idx['bk_member_offsets'], a_idx['bk_members']
+    c_offsets, c_dists = a_idx['bk_child_offsets'], a_idx['bk_child_dists']
+    level = a_idx['bk_block_roots'][[a_idx['bk_block_starts'].searchsorted(block[0])]]
+    found = list()
+    dists = list()
+    while len(level):
+        d    = calc_distances(name, [alter_name(a_idx, j) for j in members[m_offsets[level]]])
+        near = d <= radius
+        for node, dist in zip(level[near], d[near]):
+            found.append(members[m_offsets[node]:m_offsets[node + 1]])
+            dists.append(np.full(len(found[-1]), dist, dtype=np.int32))
+
+        # children whose distance to their parent is within radius of the parent's distance
+        n     = c_offsets[level + 1] - c_offsets[level]
+        kids  = gather(c_offsets, a_idx['bk_child_nodes'], level)
+        level = kids[np.abs(gather(c_offsets, c_dists, level) - np.repeat(d, n)) <= radius]
+    if not found: return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32)
+    found = np.concatenate(found)
+    order = np.argsort(found, kind='stable')
+    return found[order], np.concatenate(dists)[order]
+
+
+# INDEX FILE -----------------------------------------------------------------------------------------------------------
+
+_MAGIC = b'BIZMATCH INDEX 1\n'
+
+def save_index(a_idx, fname, header=None):
+    """
+    Save an alter index to a binary file that open_index() can memory-map.
+
+    Layout: a magic line, the length of the JSON header (8 bytes, little endian), the header itself
+    (dtype, offset and length of each column, the blocks, plus whatever is given in header), and
+    then the raw columns, each aligned on 8 bytes.
+    """
+    header  = dict(header or {})
+    columns = {name: col for name, col in a_idx.items() if isinstance(col, np.ndarray)}
+    layout  = dict()
+    offset  = 0
+    for name, col in columns.items():
+        layout[name] = [col.dtype.str, offset, len(col)]
+        offset      += _align(col.nbytes)
+    header['engine']  = a_idx['engine']
+    header['columns'] = layout
+    header['blocks']  = [[first, length, start, split, stop] for (first, length), (start, split, stop) in a_idx['blocks'].items()]
+
+    head  = json.dumps(header).encode('utf-8')
+    start = _align(len(_MAGIC) + 8 + len(head))
+    with fio.open_atomic(fname, 'wb') as f:   # atomic, so readers never see half an index
+        f.write(_MAGIC + len(head).to_bytes(8, 'little') + head)
+        for name, col in columns.items():
+            f.seek(start + layout[name][1])
+            f.write(np.ascontiguousarray(col).tobytes())
+        f.truncate(start + offset)
+
+def open_index(fname):
+    """
+    Open an alter index file saved by save_index(). The columns are read-only arrays over a memory map
+    of the file, so processes that open the same file share one copy of it (in the page cache).
+
+    Return:
+        alter index (as from index_alters), plus 'header': the header it was saved with
+    """
+    with open(fname, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if mm[:len(_MAGIC)] != _MAGIC: raise ValueError(fname + ' is not a bizmatch index file')
+    n_head = int.from_bytes(mm[len(_MAGIC):len(_MAGIC) + 8], 'little')
+    header = json.loads(mm[len(_MAGIC) + 8:len(_MAGIC) + 8 + n_head].decode('utf-8'))
+    start  = _align(len(_MAGIC) + 8 + n_head)
+
+    a_idx = {name: np.frombuffer(mm, dtype=np.dtype(dtype), count=count, offset=start + offset)
+             for name, (dtype, offset, count) in header.pop('columns').items()}
+    a_idx['blocks'] = {(first, length): (start, split, stop) for first, length, start, split, stop in header.pop('blocks')}
+    a_idx['engine'] = header.pop('engine')
+    a_idx['header'] = header
+    return a_idx
+
+def _align(n):
+    return -(-n // 8) * 8
@@ -0,0 +1,22 @@
+"""
+    Generate a synthetic list of business names (with typos, abbreviations, corp suffixes and dates),
+    of any size, e.g. to benchmark matching at scale (see bench.py).
+
+    MUST be run from the Command Line - not meant for importing!
+
+    Args:
+        argv[1] = file name to save the list to
+        argv[2] = number of names
+        argv[3] = seed                  (optional, default 0; the same seed gives the same list)
+
+"""
+
+if __name__ == "__main__":
+    from   sys import argv
+    import bench
+
+    fname = str(argv[1])
+    n     = int(argv[2])
+    seed  = int(argv[3]) if len(argv) > 3 else 0
+
+    bench.save_rows(bench.synth_rows(n, seed), fname)
@@ -2,90 +2,614 @@
     Match company names on a focal list, to company names (1-to-1 or 1-to-many) on an alter list
 """
 
+import os
+import csv
+import numpy as np
+import queue
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
 from datetime   import datetime
+from heapq      import heapify, heappush, heapreplace
+from itertools  import chain, islice
+from time       import perf_counter
 from compare    import *
+from index      import *
 from support    import *
 from settings   import *
 
+_MASK_SHIFT   = np.uint64(MASK_EXACT_BITS)
+_worker_state = None   # (alter index, rename dict) inside a worker process
+
 # MAIN MATCHING FUNCTION -----------------------------------------------------------------------------------------------
 
-def match_lists(fname_focal, fname_alter, num_batches=1, batch_no=0):
+def match_lists(fname_focal, fname_alter, num_batches=1, batch_no=0, num_workers=1, stream_focals=False):
     """
     Match business names between two lists.
 
+    Results are streamed to disk as they come in, together with a checkpoint of the focal
+    chunks done so far. If a run with the same inputs and settings gets restarted (after a
+    crash or preemption), it resumes from its checkpoint instead of starting over.
+
     Args:
         fname_focal:    filename of the focal list of business names (given one of these)
         fname_alter:    filename of the alter list of business names (try to fine one or more of these)
         num_batches:    number of batches (if running in parallel)
         batch_no:       index of the batch to run right here, right now (if running in parallel)
+        num_workers:    number of worker processes to match this batch with (they share one alter index)
+        stream_focals:  read, clean and match the focal list a chunk at a time (in constant memory),
+                        for focal lists too large to load; batches then take every num_batches-th chunk
 
     Return:
-        matched pairs and candidate (but not yet matched) pairs are saved to disk
+        matched pairs and candidate (but not yet matched) pairs are saved to disk;
+        returns True once all focal names are done (False if the batch stopped early on an error,
+        in which case rerunning it resumes from its checkpoint)
     """
 
     banner('Match business names from ' + fname_focal + ' to ' + fname_alter)
 
     # Prep
-    count           = 0
-    all_matched     = []
-    all_candids     = []
+    batch           = str(batch_no).rjust(3, '0')
+    f_matched       = '~matched.'    + batch
+    f_candids       = '~candidates.' + batch
+    f_checkpoint    = '~checkpoint.' + batch
     rename_dct      = _load_rename_dict()
-    f_lst           = _load_bizname_list(fname_focal, rename_dct)
-    a_lst           = _load_bizname_list(fname_alter, rename_dct)
-    i_start, i_stop = break_points(f_lst, batch_no, num_batches)
+    a_idx           = _load_alters(fname_alter, rename_dct)
+
+    # Chunks of focal names to match, as (chunk number, focal names grouped on clean name and date, raw rows?)
+    if stream_focals:
+        n_focals = None   # unknown until the end of the file
+        tasks    = ((k, rows, True) for k, rows in _stream_focals(fname_focal, num_batches, batch_no))
+    else:
+        f_lst           = _load_bizname_list(fname_focal, rename_dct)
+        i_start, i_stop = break_points(f_lst, batch_no, num_batches)
+        f_lst           = f_lst[i_start:i_stop]
+        n_focals        = len(f_lst)
+        f_lst           = _group_focals(f_lst)
+        chunks          = _schedule_focals(f_lst, a_idx, num_workers)
+        tasks           = ((k, [f_lst[i] for i in chunk], False) for k, chunk in enumerate(chunks))
+
+    # Resume from checkpoint (or start over)
+    run_key = _run_key(fname_focal, fname_alter, num_batches, batch_no, num_workers, stream_focals)
+    ckpt    = _load_checkpoint(f_checkpoint, run_key, f_matched, f_candids)
+    if ckpt:
+        log('Resuming batch ' + batch + ' from checkpoint (' + str(ckpt['count']) + ' focal names done)')
+    else:
+        for fname in [f_matched, f_candids, f_checkpoint, '~status.' + batch, '~profile.' + batch]:
+            fio.delete_file(fname)   # Delete temp files (of this batch)
+        ckpt = dict(key=run_key, chunks_done=0, chunks_ahead=[], sizes=[0, 0], count=0, n_matched=0, n_candids=0)
+    done, ahead = ckpt['chunks_done'], set(ckpt['chunks_ahead'])
+    tasks       = (task for task in tasks if task[0] >= done and task[0] not in ahead)
+
+    finished = False
+    with open(f_matched, 'a', encoding='utf-8') as f_m, open(f_candids, 'a', encoding='utf-8') as f_c:
+        w_matched = csv.writer(f_m, dialect='excel')
+        w_candids = csv.writer(f_c, dialect='excel')
+
+        try:
+
+            # LOOP FOCALS
+            for k, matched, candids, n in _iter_matches(tasks, a_idx, rename_dct, num_workers):
+
+                # Save results (the successful matches and the candidate potentials)
+                w_matched.writerows(matched)
+                w_candids.writerows(candids)
+                f_m.flush()
+                f_c.flush()
+
+                # CHECKPOINT
+                ckpt['chunks_ahead'].append(k)
+                while ckpt['chunks_done'] in ckpt['chunks_ahead']:
+                    ckpt['chunks_ahead'].remove(ckpt['chunks_done'])
+                    ckpt['chunks_done'] += 1
+                ckpt['sizes']      = [f_m.tell(), f_c.tell()]
+                ckpt['count']     += n
+                ckpt['n_matched'] += len(matched)
+                ckpt['n_candids'] += len(candids)
+                fio.save_json(ckpt, f_checkpoint)
+
+                # STATUS
+                if n_focals:
+                    track_status(
+                            batch + ': ' +
+                            str(ckpt['n_matched']) + ' matched / ' +
+                            str(ckpt['n_candids']).rjust(2) + ' candidates' +
+                            '  [' +
+                            str(' ' + str("%.1f" % round(
+                                    (float(ckpt['count']) / n_focals) * 100, 1)
+                                          ).rjust(4, ' ') + '%' +
+                                ']'),
+                            '~status.' + batch)
+                    printProgressBar(ckpt['count'], n_focals, prefix='Progress:', suffix='Complete', length=50)
+                else:
+                    track_status(
+                            batch + ': ' +
+                            str(ckpt['n_matched']) + ' matched / ' +
+                            str(ckpt['n_candids']).rjust(2) + ' candidates' +
+                            '  [' + str(ckpt['count']) + ' focal names]',
+                            '~status.' + batch)
+
+            finished = True
+
+        except Exception as e:
+            log_err(e)
+
+    # Stage counts and timings of this batch (see PROFILE)
+    if PROFILE: fio.save_json(profile_take(), '~profile.' + batch)
+    return finished
+
+def build_index(fname_alter):
+    """
+    Clean and index an alter list once, and save the index next to it (as fname_alter + INDEX_EXT).
+    From then on, match_lists memory-maps that file instead of cleaning the alter list again.
+    """
 
-    fio.delete_files_by_prefix('.', '~')   # Delete temp files
+    banner('Build alter index for ' + fname_alter)
+    a_idx = index_alters(_iter_bizname_list(fname_alter, _load_rename_dict()))
+    save_index(a_idx, fname_alter + INDEX_EXT, _index_header(fname_alter))
+    log('Saved ' + fname_alter + INDEX_EXT + ' (' + str(len(a_idx['members'])) + ' alter names)')
 
-    try:
+def load_alters(fname_alter):
+    """
+    Load (or memory-map, see build_index) an alter list once, to match single names against with match_name().
 
-        # LOOP FOCALS
-        for f_clean, f_raw, f_date in f_lst[i_start:i_stop]:
+    Return:
+        (alter index, rename dict)
+    """
+    rename_dct = _load_rename_dict()
+    return _load_alters(fname_alter, rename_dct), rename_dct
 
-            matched, candids = _match_alters(f_clean, f_raw, f_date, a_lst, rename_dct)
+def match_name(name, alters, date=''):
+    """
+    Match a single business name (e.g. an interactive lookup) against an alter list.
 
-            if matched: all_matched.extend(matched)
-            if candids: all_candids.extend(candids)
+    Args:
+        name:           raw business name
+        alters:         (alter index, rename dict) from load_alters()
+        date:           date of the name (in DATE_FORMAT), if any
 
-            # STATUS
-            track_status(
-                    str(batch_no).rjust(3, '0') + ': ' +
-                    str(len(all_matched)) + ' matched / ' +
-                    str(len(all_candids)).rjust(2) + ' candidates' +
-                    '  [' +
-                    str(' ' + str("%.1f" % round(
-                            (float(count) / (i_stop - i_start)) * 100, 1)
-                                  ).rjust(4, ' ') + '%' +
-                        ']'),
-                    '~status.' + str(batch_no).rjust(3, '0'))
-            count += 1
-            printProgressBar(count, len(f_lst[i_start:i_stop]), prefix='Progress:', suffix='Complete', length=50)
+    Return:
+        (matched pairs, candidate pairs) of (name, alter name); with CANDID_TOP_K, the best candidates
+        only, ranked, as (name, alter name, distance, ratio)
+    """
+    a_idx, rename_dct = alters
+    return _match_alters(*_parse_bizname([name, date], rename_dct), a_idx, rename_dct)
+
+def match_increment(fname_focal, fname_alter, num_workers=1):
+    """
+    Match only what is new since the last incremental run, for lists that grow by appending rows: all focal
+    names against the alter rows appended since then, and the focal rows appended since then against all
+    alter names. The new pairs get merged into F_MATCHED and F_CANDIDATES, which then hold what a full run
+    (and run_batches.py) would have produced for both lists.
+
+    What has been matched so far is kept in the F_INCREMENT files: the size and hash of both lists, the
+    cleaned focal names (.focals), the pairs so far per focal name and date (.matched and .candidates),
+    and the alter index in segments (.#.idx, one per run, with the newer ones merged into one every
+    INCREMENT_SEGMENTS runs). If a list changed other than by appending rows,
+    the settings or config changed, or results have gone missing, it starts over with a full run.
+
+    Args:
+        fname_focal:    filename of the focal list of business names
+        fname_alter:    filename of the alter list of business names
+        num_workers:    number of worker processes to match with
 
-    except Exception as e:
-        log_err(e)
+    Return:
+        matched pairs and candidate pairs are saved to disk
+    """
+
+    banner('Match business names added to ' + fname_focal + ' or ' + fname_alter)
+
+    rename_dct = _load_rename_dict()
+    f_state    = F_INCREMENT + '.json'
+    f_focals   = F_INCREMENT + '.focals'
+    f_matched  = F_INCREMENT + '.matched'
+    f_candids  = F_INCREMENT + '.candidates'
+    state, now = _load_increment(fname_focal, fname_alter)
+    if not state:
+        fio.delete_files_by_prefix(os.path.dirname(F_INCREMENT), os.path.basename(F_INCREMENT) + '.')
+        state = dict(key=_increment_key(), focal=dict(size=0), alter=dict(size=0), segments=[], focals_size=0, runs=0)
+
+    # clean the rows appended to both lists (cutting the cleaned focals back to the last run, in case it crashed)
+    lists = dict()
+    for side, fname in (('focal', fname_focal), ('alter', fname_alter)):
+        start, stop = state[side]['size'], now[side]['size']
+        rows        = [_parse_bizname(row, rename_dct) for row in _read_csv_between(fname, start, stop)]
+        lists[side] = now[side], rows
+        log(str(len(rows)) + ' new rows in ' + fname)
+    new_focals, new_alters = lists['focal'][1], lists['alter'][1]
+    if os.path.exists(f_focals): os.truncate(f_focals, state['focals_size'])
+    with open(f_focals, 'a', encoding='utf-8') as f:
+        csv.writer(f, dialect='excel').writerows(['' if v is None else v for v in row] for row in new_focals)
+
+    # prior results first, then the new pairs of each segment of the alter list, in alter list order
+    parts = []
+    if state['runs']:
+        parts.append(tuple([((row[0], row[1]),) + tuple(row[2:]) for row in fio.load_csv(fname)]
+                           for fname in (f_matched, f_candids)))
+    if new_focals:
+        for f_segment in state['segments']:
+            parts.append(_match_all(new_focals, open_index(f_segment), rename_dct, num_workers))
+    if new_alters:
+        a_idx = index_alters(new_alters)
+        parts.append(_match_all(_read_clean_rows(f_focals), a_idx, rename_dct, num_workers))
+    matched, candids = _merge_results(parts)
+    fio.save_csv([list(key) + row for key, *row in matched], f_matched)
+    fio.save_csv([list(key) + row for key, *row in candids], f_candids)
+    ranked = []   # candidates with their focal row (date) and rank (see save_results)
+    for n, (key, *row) in enumerate(candids):
+        rank = rank + 1 if n and candids[n - 1][0] == key else 0   # (candidates come grouped by focal row)
+        ranked.append((key[0],) + tuple(row) + (key[1], rank))
+    matched, candids = save_results([(key[0],) + tuple(row) for key, *row in matched],
+                                    ranked if CANDID_TOP_K else [row[:-2] for row in ranked])
+
+    # add the new alters as one more segment (merging the newer segments, once there are too many)
+    segments, stale = list(state['segments']), []
+    if new_alters:
+        segments.append(F_INCREMENT + '.' + str(state['runs']) + INDEX_EXT)
+        save_index(a_idx, segments[-1])
+    if len(segments) > INCREMENT_SEGMENTS:
+        stale    = segments[1:]
+        segments = segments[:1] + [F_INCREMENT + '.' + str(state['runs']) + '.merged' + INDEX_EXT]
+        save_index(index_alters(chain.from_iterable(index_rows(open_index(f)) for f in stale)), segments[-1])
+    fio.save_json(dict(key=state['key'], focal=lists['focal'][0], alter=lists['alter'][0], segments=segments,
+                       focals_size=os.path.getsize(f_focals), runs=state['runs'] + 1), f_state)
+    for fname in stale: fio.delete_file(fname)
+
+    log_info(str(len(matched)).rjust(9) + ' matches')
+    log_info(str(len(candids)).rjust(9) + ' candidates')
+
+def save_results(matched, candids):
+    """
+    Save matched and candidate pairs to F_MATCHED and F_CANDIDATES, each pair once, sorted on focal name and
+    then alter name. Ranked candidates (see CANDID_TOP_K) come as (focal, alter, distance, ratio, focal date,
+    rank) instead, and are sorted on focal name, date and rank, then saved without those last two.
 
-    # Save results (the successful matches and the candidate potentials)
-    fio.save_csv(all_matched, '~matched.'    + str(batch_no).rjust(3, '0'))
-    fio.save_csv(all_candids, '~candidates.' + str(batch_no).rjust(3, '0'))
+    Return:
+        (matched pairs, candidate pairs) as saved
+    """
+    matched = sorted(dict.fromkeys(tuple(row) for row in matched))
+    if CANDID_TOP_K:
+        candids = sorted(candids, key=lambda row: (row[0], row[4], int(row[5])))
+        candids = list(dict.fromkeys(tuple(row[:4]) for row in candids))
+    else:
+        candids = sorted(dict.fromkeys(tuple(row) for row in candids))
+    fio.save_csv(matched, F_MATCHED)
+    fio.save_csv(candids, F_CANDIDATES)
+    return matched, candids
 
 # SUPPORTING FUNCTIONS -------------------------------------------------------------------------------------------------
 
-def _match_alters(f_clean, f_raw, f_date, a_lst, rename_dct):
+@profiled('load_alters')
+def _load_alters(fname_alter, rename_dct):
+    """Alter index: memory-mapped from its prebuilt index file if that is up to date, else cleaned and indexed here."""
+    f_index = fname_alter + INDEX_EXT
+    if os.path.exists(f_index):
+        a_idx = open_index(f_index)
+        if a_idx['engine'] == MATCH_ENGINE and _index_is_current(a_idx['header'], fname_alter):
+            log('Opened alter index ' + f_index)
+            a_idx['fname'] = f_index
+            return a_idx
+        log_warn('Ignoring ' + f_index + ' (out of date, or built for another MATCH_ENGINE; rebuild it with build_index.py)')
+    return index_alters(_iter_bizname_list(fname_alter, rename_dct))
+
+def _index_header(fname_alter):
+    """What an alter index file was built from: the cleaning config, and the alter list itself."""
+    return dict(config=_index_config(),
+                source=dict(size=os.path.getsize(fname_alter), mtime=os.path.getmtime(fname_alter),
+                            sha1=fio.hash_file(fname_alter)))
+
+def _index_is_current(header, fname_alter):
+    """Check an index file header against the config and alter list (only hashing the list if its size or mtime moved)."""
+    source = header.get('source', {})
+    if header.get('config') != _index_config(): return False
+    if source.get('size') != os.path.getsize(fname_alter): return False
+    return source.get('mtime') == os.path.getmtime(fname_alter) or source.get('sha1') == fio.hash_file(fname_alter)
+
+def _index_config():
+    """Key of what decides the contents of an index file: the cleaning config and the index code itself."""
+    return fio.hash_keys([CONFIG_FINGERPRINT, DATE_FORMAT, INDEX_FINGERPRINT])
+
+def _group_focals(f_lst):
+    """
+    Group focal names on (clean name, date), so each group gets matched only once (undated
+    names with the same clean name form one group).
+
+    Return:
+        list of (clean name, raw names, date ordinal or None), in order of first appearance
+    """
+    groups = dict()
+    for f_clean, f_raw, f_date in f_lst:
+        groups.setdefault((f_clean, f_date), []).append(f_raw)
+    return [(f_clean, f_raws, f_date) for (f_clean, f_date), f_raws in groups.items()]
+
+def _schedule_focals(f_lst, a_idx, num_workers=1):
+    """
+    Split focal names into chunks (of indexes into f_lst), in the order to match them.
+
+    In this process, chunks follow the focal list. For a worker pool, the most expensive chunks
+    go first and the rest are handed out as workers free up (so all workers finish together).
+    """
+    if num_workers <= 1:
+        return [list(range(i, min(i + WORKER_CHUNK_SIZE, len(f_lst)))) for i in range(0, len(f_lst), WORKER_CHUNK_SIZE)]
+    costs = [_estimate_cost(f_clean, f_date, a_idx) for f_clean, _, f_date in f_lst]
+    return schedule_chunks(costs, WORKER_CHUNK_SIZE)
+
+def _stream_focals(fname, num_batches=1, batch_no=0):
+    """
+    Read a focal list lazily, a chunk of raw rows at a time (chunk k goes to batch k % num_batches).
+
+    Return:
+        generator of (chunk number within the batch, raw rows)
+    """
+    rows = fio.read_csv(fname)
+    k    = 0
+    while True:
+        chunk = list(islice(rows, WORKER_CHUNK_SIZE))
+        if not chunk: break
+        if k % num_batches == batch_no: yield k // num_batches, chunk
+        k += 1
+
+def _iter_matches(tasks, a_idx, rename_dct, num_workers=1):
+    """
+    Match chunks of focal names against the alter index, in this process or in a pool of worker processes.
+
+    Args:
+        tasks:          iterable of (chunk number, focal name groups (see _group_focals), raw rows?),
+                        where raw rows still need cleaning and grouping
+
+    Return:
+        generator of (chunk number, matched, candids, number of focals done), as results come in
+        (in chunk order in this process; in order of completion from a worker pool)
+    """
+    if num_workers <= 1:
+        for task in tasks:
+            yield _match_task(task, a_idx, rename_dct)
+        return
+
+    # keep only a few chunks per worker in flight, so tasks are read no faster than they get matched
+    results = queue.Queue()
+    pending = 0
+    pool    = _worker_pool(num_workers, a_idx, rename_dct)
+    try:
+        for task in chain(tasks, [None]):
+            if task is not None:
+                pool.submit(_match_chunk, task).add_done_callback(results.put)
+                pending += 1
+            while pending and (task is None or pending >= 2 * num_workers):
+                result   = results.get().result()   # raises what the worker raised (BrokenProcessPool if it died)
+                pending -= 1
+                profile_merge(result[-1])   # stage counts and timings of the worker
+                yield result[:-1]
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+def _worker_pool(num_workers, a_idx, rename_dct):
+    """
+    Pool of worker processes that share the (already cleaned and indexed) alter list.
+
+    Forked workers inherit the index copy-on-write; where fork is not available, each
+    worker gets its own copy once, through the pool initializer (or maps the same index file).
+    """
+    if 'fork' in mp.get_all_start_methods():
+        _init_worker(a_idx, rename_dct)
+        return ProcessPoolExecutor(num_workers, mp.get_context('fork'), initializer=profile_take)   # workers count from zero
+    return ProcessPoolExecutor(num_workers, initializer=_init_worker, initargs=(a_idx.get('fname', a_idx), rename_dct))
+
+def _init_worker(a_idx, rename_dct):
+    global _worker_state
+    if isinstance(a_idx, str): a_idx = open_index(a_idx)
+    _worker_state = (a_idx, rename_dct)
+
+def _match_chunk(task):
+    return _match_task(task, *_worker_state) + (profile_take() if PROFILE else None,)
+
+def _match_task(task, a_idx, rename_dct):
+    k, focals, raw = task
+    if raw: focals = _group_focals(_parse_bizname(row, rename_dct) for row in focals)
+    all_matched = []
+    all_candids = []
+    n           = 0
+    for f_clean, f_raws, f_date in focals:
+
+        # match each group once, then hand its results to every raw name in it
+        matched, candids = _match_alters(f_clean, f_raws[0], f_date, a_idx, rename_dct)
+        if CANDID_TOP_K:   # ranked: add the focal row (date) and rank, to sort on when chunks come back out of order
+            f_row   = '' if f_date is None else str(f_date)
+            candids = [pair + (f_row, r) for r, pair in enumerate(candids)]
+        for f_raw in f_raws:
+            all_matched.extend((f_raw,) + pair[1:] for pair in matched)
+            all_candids.extend((f_raw,) + pair[1:] for pair in candids)
+        n += len(f_raws)
+    return k, all_matched, all_candids, n
+
+@profiled('match_alters')
+def _match_alters(f_clean, f_raw, f_date, a_idx, rename_dct, days_before=ALLOW_DAYS_BEFORE, days_after=ALLOW_DAYS_AFTER, candidate_diff=CANDID_DIFF, candidate_threshold=CANDID_THRESHOLD, top_k=CANDID_TOP_K):
+    """
+    Match one focal name against the alter index (same rules as _match_names, a block at a time).
+
+    Exact matches come first, from a hash lookup. If one to many is not allowed, a focal name with
+    an exact match is done right there: it gets its first exact match (in alter list order) and no
+    candidates.
+
+    With top_k, only the k best candidates are kept (in a heap of k, as they are scored), and they
+    come back ranked as (focal, alter, distance, ratio), where ratio = 1 - distance / min length;
+    highest ratio first (ties in alter list order). An alter name on several rows takes one place,
+    with its best row. Otherwise all candidates come back as (focal, alter),
+    in alter list order.
+    """
 
     matched = list()
     candids = list()
+    ranked  = list()   # heap of the top_k candidates so far, as (ratio, -alter row, distance, alter name)
+    in_rank = dict()   # alter name -> its entry in ranked
+    n_found = 0
 
     assert rename_dct   # NOTE >> not being used yet - but require it now for future compatability
 
-    for a_clean, a_raw, a_date in a_lst:
-
-        m, c = _match_names(f_clean, f_raw, f_date, a_clean, a_raw, a_date)
-        if m: matched.append(m)
-        if c: candids.append(c)
-
-        if not ALLOW_ONE_2_MANY and m: break
+    if not f_clean or not f_raw: return matched, candids
+    if PROFILE: t = perf_counter()
+
+    # only visit the blocks that can pass the first char and length tests
+    f_len   = len(f_clean)
+    f_mask  = char_mask(f_clean)
+    f_n     = popcount_int(f_mask)
+    f_mask  = np.uint64(f_mask)
+    masks   = a_idx['masks']
+    n_chars = a_idx['n_chars']
+    blocks  = [(a_len, a_idx['blocks'].get((f_clean[0], a_len)))
+               for a_len in range(f_len - candidate_diff, f_len + candidate_diff + 1)]
+
+    # jump straight to the alters inside the date window (undated alters always qualify)
+    blocks  = [(a_len, block, block_ranges(a_idx, block, f_date, days_before, days_after))
+               for a_len, block in blocks if block]
+    visit   = sum(stop - start for _, _, ranges in blocks for start, stop in ranges)
+
+    # alters left after each of those tests (the blocks are sorted on first char)
+    if PROFILE:
+        first = ord(f_clean[0])
+        profile_add('match_alters.first_char', items=int(np.searchsorted(a_idx['firsts'], first, 'right') -
+                                                         np.searchsorted(a_idx['firsts'], first, 'left')))
+        profile_add('match_alters.length', items=sum(block[2] - block[0] for _, block, _ in blocks))
+        profile_add('match_alters.dates',  items=visit)
+
+    # EXACT MATCHES first, from the hash map of cleaned names (in the focal's own block and date window)
+    exact = list()
+    for a_len, block, ranges in blocks:
+        if a_len == f_len:
+            same  = exact_matches(a_idx, f_clean, block[0], block[2])
+            same  = [j for j in same.tolist() if any(start <= j < stop for start, stop in ranges)]
+            exact = sorted(alter_rows(a_idx, same).tolist())
+
+    if PROFILE: profile_add('match_alters.exact', perf_counter() - t, len(exact))
+
+    # a focal with an exact match is done, unless it can match one to many
+    if exact and not ALLOW_ONE_2_MANY:
+        matched.append((f_raw, alter_raw(a_idx, exact[0])))
+        return matched, candids
+    hits = [(i, True) for i in exact]
+
+    # scan, unless there are enough alters to visit for an engine's index to pay off
+    engine = 'scan'
+    if visit >= INDEX_MIN_VISIT: engine = a_idx['engine']
+    if PROFILE: t = perf_counter()
+
+    # trigrams shared with each alter in those blocks (which sit next to each other in the index)
+    shared = None
+    if engine == 'ngram' and blocks:
+        span   = blocks[0][1][0]
+        shared = shared_grams(a_idx, f_clean, span, blocks[-1][1][2])
+
+    # alters that share a delete variant with the focal name, in the blocks the delete map covers
+    # (names short enough that max_dist never exceeds the deletes indexed)
+    deletes = None
+    if engine == 'symspell':
+        sym_dist, sym_len = (int(v) for v in a_idx['sym_params'])
+        covered = [a_len <= sym_len and max_distance(f_len, a_len, candidate_threshold) <= sym_dist
+                   for a_len, _, _ in blocks]
+        if any(covered):
+            deletes = shared_deletes(a_idx, f_clean, blocks[0][1][0], blocks[-1][1][2])
+
+    for b, (a_len, block, ranges) in enumerate(blocks):
+        max_dist = max_distance(f_len, a_len, candidate_threshold)
+        min_gram = min_shared_grams(f_len, a_len, max_dist)
+        probed   = deletes is not None and covered[b]
+
+        # BK-tree: all alters of the block within max_dist of the focal name (with their distances)
+        found = bk_search(a_idx, f_clean, block, max_dist) if engine == 'bktree' else None
+        if PROFILE and engine != 'scan':
+            profile_add('match_alters.' + engine, perf_counter() - t)
+            t = perf_counter()
+
+        for start, stop in ranges:
+            if start >= stop: continue
+            dists = None
+
+            # unique char test on the whole slice at once
+            if found is None and not probed and (shared is None or min_gram <= 0):
+                common = popcount(masks[start:stop] & f_mask).astype(np.int16)
+                keep   = np.flatnonzero(np.maximum(n_chars[start:stop], f_n) - common <= candidate_diff) + start
+
+            # or on the alters that the BK-tree, the delete map or the count filter let through
+            # (too few shared trigrams means too many edits; no count filter if the bound is 0)
+            else:
+                if found is not None:
+                    inside      = (found[0] >= start) & (found[0] < stop)
+                    keep, dists = found[0][inside], found[1][inside]
+                elif probed:
+                    keep = deletes[deletes.searchsorted(start):deletes.searchsorted(stop)]
+                else:
+                    keep = np.flatnonzero(shared[start - span:stop - span] >= min_gram) + start
+                common = popcount(masks[keep] & f_mask).astype(np.int16)
+                chars  = np.maximum(n_chars[keep], f_n) - common <= candidate_diff
+                keep   = keep[chars]
+                if dists is not None: dists = dists[chars]
+            if PROFILE:
+                profile_add('match_alters.prefilter', perf_counter() - t, len(keep))
+                t = perf_counter()
+            if not len(keep): continue
+
+            # masks with folded chars only bound the char diff, so recheck those exactly
+            folded = (masks[keep] | f_mask) >> _MASK_SHIFT != 0
+            if folded.any():
+                chars = np.array([not fold or calc_char_diff(f_clean, alter_name(a_idx, j)) <= candidate_diff
+                                  for j, fold in zip(keep, folded)])
+                keep  = keep[chars]
+                if dists is not None: dists = dists[chars]
+
+            # score the survivors in one call (exact matches, at distance 0, are in already)
+            if dists is None: dists = calc_distances(f_clean, alter_names(a_idx, keep), max_dist)
+            near = (dists <= max_dist) & (dists > 0)
+            if top_k:
+                min_len = min(f_len, a_len)
+                offsets = a_idx['member_offsets']
+                places  = keep[near]
+                rows    = alter_rows(a_idx, places)
+                dists   = np.repeat(dists[near], offsets[places + 1] - offsets[places])   # one per row, not per position
+                for i, dist in zip(rows.tolist(), dists.tolist()):
+                    item = (1 - dist / min_len, -i, dist, alter_raw(a_idx, i))
+                    kept = in_rank.get(item[3])
+                    if kept is not None:   # same alter name on another row: keep the better one
+                        if item > kept:
+                            ranked[ranked.index(kept)] = in_rank[item[3]] = item
+                            heapify(ranked)
+                    elif len(ranked) < top_k:
+                        heappush(ranked, item)
+                        in_rank[item[3]] = item
+                    elif item > ranked[0]:
+                        del in_rank[heapreplace(ranked, item)[3]]
+                        in_rank[item[3]] = item
+                    n_found += 1
+            else:
+                for i in alter_rows(a_idx, keep[near]).tolist():
+                    hits.append((i, False))
+            if PROFILE:
+                profile_add('match_alters.score', perf_counter() - t, len(keep))
+                t = perf_counter()
+
+    if PROFILE: profile_add('match_alters.hits', items=len(hits) + n_found)
+
+    # restore alter list order (so results are identical to a full scan)
+    hits.sort()
+    for i, is_exact in hits:
+        if is_exact: matched.append((f_raw, alter_raw(a_idx, i)))
+        else:        candids.append((f_raw, alter_raw(a_idx, i)))
+
+    # best candidates first
+    for ratio, _, dist, a_raw in sorted(ranked, reverse=True):
+        candids.append((f_raw, a_raw, dist, round(ratio, 4)))
 
     return matched, candids
 
+def _estimate_cost(f_clean, f_date, a_idx, candidate_diff=CANDID_DIFF):
+    """Estimated cost of matching a focal name: the number of alters it visits in the index."""
+    cost = 0
+    if f_clean:
+        for a_len in range(len(f_clean) - candidate_diff, len(f_clean) + candidate_diff + 1):
+            block = a_idx['blocks'].get((f_clean[0], a_len))
+            if block is None: continue
+            cost += sum(stop - start for start, stop in block_ranges(a_idx, block, f_date))
+    return cost
+
+@profiled('match_names')
 def _match_names(f_clean, f_raw, f_date, a_clean, a_raw, a_date, days_before=ALLOW_DAYS_BEFORE, days_after=ALLOW_DAYS_AFTER, candidate_diff=CANDID_DIFF, candidate_threshold=CANDID_THRESHOLD):
 
 
@@ -100,7 +624,7 @@ def _match_names(f_clean, f_raw, f_date, a_clean, a_raw, a_date, days_before=ALL
             # precalc date check
             dates_ok = True
             if f_date and a_date:
-                days = (a_date - f_date).days
+                days = a_date - f_date
                 if days >  days_after:  dates_ok = False
                 if days < -days_before: dates_ok = False
 
@@ -110,53 +634,224 @@ def _match_names(f_clean, f_raw, f_date, a_clean, a_raw, a_date, days_before=ALL
                 # check diff in string lengths
                 if abs(len(f_clean)-len(a_clean)) <= candidate_diff:
 
-                    f_chars = {c for c in f_clean}
-                    a_chars = {c for c in a_clean}
-                    common  = f_chars.intersection(a_chars)
-                    n_diff  = abs(max(len(f_chars),len(a_chars)) - len(common))
-
                     # check num of different unique chars
-                    if n_diff <= candidate_diff:
+                    if calc_char_diff(f_clean, a_clean) <= candidate_diff:
 
-                        # calc dist now (late) to save runtime
-                        dist = calc_distance(f_clean, a_clean)
+                        # calc dist now (late) to save runtime, and stop once it cannot pass the threshold
+                        max_dist = max_distance(len(f_clean), len(a_clean), candidate_threshold)
+                        dist     = calc_distance(f_clean, a_clean, max_dist)
 
                         # EXACT MATCH
                         if dist == 0:
                             matched = (f_raw, a_raw)
 
-                        # Potential Candidate?
-                        else:
-
-                            # calc % of name that is similar
-                            ratio = 1 - (float(dist) /
-                                           min(len(f_clean),len(a_clean)))
-
-                            # CANDIDATE
-                            if ratio > candidate_threshold:
-                                candid = (f_raw, a_raw)
+                        # CANDIDATE (same as: 1 - dist / min length > candidate_threshold)
+                        elif dist <= max_dist:
+                            candid = (f_raw, a_raw)
 
     # return
     return matched, candid
 
+@profiled('load_bizname_list')
 def _load_bizname_list(fname, rename_dct):
+    return list(_iter_bizname_list(fname, rename_dct))
+
+def _iter_bizname_list(fname, rename_dct):
+    """Read, clean and yield a list of business names a row at a time (from its cache, if there is one)."""
     log('Loading ' + fname + ' ...')
 
-    f_lst = fio.load_csv(fname)
-    if len(f_lst[0]) == 1: f_lst = [ (n, None) for n in f_lst]  # Add if missing
-        
-    f_out = []
-    for raw_name, d in f_lst:
-        if d: 
-            f_out.append( (clean_name(raw_name, rename_dct), raw_name, datetime.strptime(d, DATE_FORMAT)) )
-        else:
-            f_out.append( (clean_name(raw_name, rename_dct), raw_name, None) )
-    return f_out
+    f_cache = _cache_fname(fname)
+    if f_cache and os.path.exists(f_cache):
+        yield from _read_clean_rows(f_cache)
+        return
+
+    yield from _cache_rows((_parse_bizname(row, rename_dct) for row in fio.read_csv(fname)), f_cache)
+
+def _read_clean_rows(fname):
+    """Read back (clean name, raw name, date ordinal or None) rows saved to a csv file"""
+    for clean, raw, d in fio.read_csv(fname):
+        yield clean, raw, int(d) if d else None
+
+def _parse_bizname(row, rename_dct):
+    """(clean name, raw name, date ordinal or None) from a [raw_name], [date] (optional) row"""
+    raw_name = row[0] if row else ''
+    d        = row[1] if len(row) > 1 else ''
+    if d:
+        return clean_name(raw_name, rename_dct), raw_name, datetime.strptime(d, DATE_FORMAT).toordinal()
+    else:
+        return clean_name(raw_name, rename_dct), raw_name, None
 
 def _load_rename_dict():
     log('Loading rename list...')
+
+    f_cache = _cache_fname(F_RENAME, keyed_on_file=False)
+    if f_cache and os.path.exists(f_cache):
+        return dict(fio.load_csv(f_cache))
+
     rename_dct = dict()
     for oldname, newname in RENAMES:
         rename_dct[oldname] = newname
         rename_dct[clean_name(oldname)] = newname
+
+    _save_cache(rename_dct.items(), f_cache)
     return rename_dct
+
+def _run_key(fname_focal, fname_alter, num_batches, batch_no, num_workers, stream_focals):
+    """Key of everything that decides what a batch produces (and in which chunks), to check a checkpoint against."""
+    keys = [CONFIG_FINGERPRINT, DATE_FORMAT, repr((CANDID_DIFF, CANDID_THRESHOLD, CANDID_TOP_K, ALLOW_ONE_2_MANY,
+                                                   ALLOW_DAYS_BEFORE, ALLOW_DAYS_AFTER, WORKER_CHUNK_SIZE)),
+            repr((num_batches, batch_no, num_workers > 1, stream_focals))]
+    for fname in (fname_focal, fname_alter):
+        keys += [fio.hash_file(fname), str(os.path.getmtime(fname))]
+    return fio.hash_keys(keys)
+
+def _load_checkpoint(f_checkpoint, run_key, f_matched, f_candids):
+    """
+    Checkpoint of an earlier run of this batch (if it was for the same key), with the
+    output files cut back to what they held at that checkpoint. None if no resume is possible.
+    """
+    ckpt = fio.load_json(f_checkpoint, default_no_file=True)
+    if not ckpt or ckpt.get('key') != run_key: return None
+    for fname, size in zip((f_matched, f_candids), ckpt['sizes']):
+        if not os.path.exists(fname) or os.path.getsize(fname) < size: return None
+    for fname, size in zip((f_matched, f_candids), ckpt['sizes']):
+        os.truncate(fname, size)   # drop any rows written after the checkpoint
+    return ckpt
+
+def _cache_fname(fname, keyed_on_file=True):
+    """
+    Cache file for the cleaned version of fname.
+
+    Named <file name>.<path hash>.<key>: the hash of the absolute path of fname tells apart lists
+    with the same name in different directories. The key combines the config fingerprint (config
+    files and cleaning code), DATE_FORMAT and (if keyed_on_file) the hash and mtime of fname itself,
+    so any change misses the cache and the stale file gets replaced on save.
+    """
+    if not USE_CACHE: return ''
+    keys = [CONFIG_FINGERPRINT, DATE_FORMAT]
+    if keyed_on_file: keys += [fio.hash_file(fname), str(os.path.getmtime(fname))]
+    key  = fio.hash_keys(keys)
+    path = fio.hash_keys([os.path.abspath(fname)])
+    return PATH_CACHE + os.path.basename(fname) + '.' + path[:8] + '.' + key[:16]
+
+def _save_cache(rows, f_cache):
+    for _ in _cache_rows(rows, f_cache): pass
+
+def _cache_rows(rows, f_cache):
+    """Pass rows through (as a generator), saving them to the cache file once they have all gone by."""
+    if not f_cache:
+        yield from rows
+        return
+    rows  = iter(rows)
+    fname = os.path.basename(f_cache)
+    f_tmp = PATH_CACHE + 'tmp.' + str(os.getpid()) + '.' + fname
+    try:
+        os.makedirs(PATH_CACHE, exist_ok=True)
+        with fio.open_atomic(f_cache, ftmp=f_tmp) as f:   # atomic, in case batches race to write the same cache
+            writer = csv.writer(f, dialect='excel')
+            for row in rows:
+                yield row
+                writer.writerow(['' if v is None else v for v in row])
+            fio.delete_files_by_prefix(PATH_CACHE, fname.rsplit('.', 1)[0] + '.')   # stale versions (same name and path)
+    except OSError as e:
+        log_warn('Unable to cache ' + f_cache + ': ' + str(e))
+        yield from rows   # the rest of them, uncached
+
+def _load_increment(fname_focal, fname_alter):
+    """
+    State of the last incremental run, if the next one can carry on from it (else None, to start over), and
+    the size and hash of both lists now, by side (each list hashed once, along with what the last run saw of it).
+    """
+    state = fio.load_json(F_INCREMENT + '.json', default_no_file=True)
+    now   = dict()
+    seen  = dict()   # hash now of what the last run saw of each list
+    for side, fname in (('focal', fname_focal), ('alter', fname_alter)):
+        size = os.path.getsize(fname)
+        seen[side], sha1 = fio.hash_prefixes(fname, [min(state[side]['size'], size) if state else 0, size])
+        now[side] = dict(size=size, sha1=sha1)
+    if not state: return None, now
+    fnames = [F_INCREMENT + '.focals', F_INCREMENT + '.matched', F_INCREMENT + '.candidates'] + state['segments']
+    if state.get('key') != _increment_key():
+        log_warn('Starting over: the settings or config changed since the last incremental run')
+    elif not all(os.path.exists(fname) for fname in fnames):
+        log_warn('Starting over: results of the last incremental run have gone missing')
+    elif not _appended(fname_focal, state['focal'], seen['focal']) or not _appended(fname_alter, state['alter'], seen['alter']):
+        log_warn('Starting over: a list changed other than by appending rows')
+    else:
+        return state, now
+    return None, now
+
+def _increment_key():
+    """Key of everything that decides the results of an incremental run (other than the lists themselves)."""
+    return fio.hash_keys([_index_config(), MATCH_ENGINE, repr((
+            CANDID_DIFF, CANDID_THRESHOLD, CANDID_TOP_K, ALLOW_ONE_2_MANY, ALLOW_DAYS_BEFORE, ALLOW_DAYS_AFTER))])
+
+def _appended(fname, seen, sha1):
+    """
+    Check that a list still starts with what an earlier run saw of it (seen: its size and hash then; sha1: the
+    hash now of as much of the list)
+    """
+    size = seen['size']
+    if not size: return True
+    if os.path.getsize(fname) < size or sha1 != seen['sha1']: return False
+    with open(fname, 'rb') as f:
+        f.seek(size - 1)
+        return f.read(1) == b'\n' or os.path.getsize(fname) == size   # rows get appended after a full line
+
+def _read_csv_between(fname, start, stop):
+    """Rows of a csv file from byte offset start (the start of a row) up to byte offset stop"""
+    def lines():
+        with open(fname, 'rb') as f:
+            f.seek(start)
+            at = start
+            for line in f:
+                at += len(line)
+                if at > stop: break
+                yield line.decode('utf-8')
+    return csv.reader(lines(), dialect='excel')
+
+def _match_all(f_rows, a_idx, rename_dct, num_workers=1):
+    """
+    (matched pairs, candidate pairs) of cleaned focal rows against an alter index, where each pair starts
+    with the (raw name, date) of its focal row instead of just its raw name (see _merge_results)
+    """
+    f_lst   = [(f_clean, [(f_raw, '' if f_date is None else str(f_date)) for f_raw in f_raws], f_date)
+               for f_clean, f_raws, f_date in _group_focals(f_rows)]
+    tasks   = ((k, [f_lst[i] for i in chunk], False) for k, chunk in enumerate(_schedule_focals(f_lst, a_idx, num_workers)))
+    matched = []
+    candids = []
+    for _, m, c, _ in _iter_matches(tasks, a_idx, rename_dct, num_workers):
+        matched += m
+        candids += [row[:4] for row in c] if CANDID_TOP_K else c   # the key has the date, ranks get redone on merging
+    return matched, candids
+
+def _merge_results(parts, top_k=CANDID_TOP_K):
+    """
+    Merge the (matched pairs, candidate pairs) of focal rows against consecutive parts of the alter list (in
+    alter list order) into what matching them against the whole alter list at once gives. Pairs are merged
+    per focal row, (raw name, date), as a focal name can show up on several rows with other dates: one to
+    one keeps the first match of a row (and drops its candidates), and top_k ranks the candidates of a row
+    again (an alter name once, ties in order).
+
+    Return:
+        (matched pairs, candidate pairs) as ((raw name, date), alter name, ...), values as str (as read
+        back from csv)
+    """
+    matched = dict()   # focal row -> ordered set of pairs
+    candids = dict()
+    for part_matched, part_candids in parts:
+        for rows, merged in ((part_matched, matched), (part_candids, candids)):
+            for key, *row in rows:
+                merged.setdefault(tuple(key), dict())[tuple(str(v) for v in row)] = None
+    if not ALLOW_ONE_2_MANY:
+        for key, rows in matched.items():
+            matched[key] = list(rows)[:1]
+            candids.pop(key, None)
+    if top_k:
+        for key, rows in candids.items():
+            best = dict()   # alter name -> its best pair
+            for row in sorted(rows, key=lambda row: -float(row[2])):
+                best.setdefault(row[0], row)
+            candids[key] = list(best.values())[:top_k]
+    return ([(key,) + row for key, rows in matched.items() for row in rows],
+            [(key,) + row for key, rows in candids.items() for row in rows])
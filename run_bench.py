@@ -0,0 +1,45 @@
+"""
+    Benchmark clean_name, _match_names and an end-to-end match_lists, and save the results
+    (throughput and memory peaks, see bench.py) as JSON in F_BENCH.
+
+    MUST be run from the Command Line - not meant for importing!
+
+    Args:
+        argv[1] = number of synthetic names to clean, and of pairs to match     (optional, default 100000)
+        argv[2] = alter list for the end-to-end match, or a number of
+                  synthetic alter names to generate for it instead             (optional, default _sdc_biznames.csv)
+        argv[3] = number of focal names for the end-to-end match               (optional, default 10000)
+        argv[4] = number of worker processes for the end-to-end match          (optional, default 1)
+        argv[5] = results of an earlier run to compare against                 (optional)
+
+"""
+
+if __name__ == "__main__":
+    import fio
+    import bench
+    from   sys      import argv
+    from   support  import *
+    from   settings import *
+
+    n_names     = int(argv[1]) if len(argv) > 1 else 100000
+    fname_alter = str(argv[2]) if len(argv) > 2 else '_sdc_biznames.csv'
+    n_focals    = int(argv[3]) if len(argv) > 3 else 10000
+    num_workers = int(argv[4]) if len(argv) > 4 else 1
+    f_baseline  = str(argv[5]) if len(argv) > 5 else ''
+    n_alters    = int(fname_alter) if fname_alter.isdigit() else 0
+
+    banner('BENCHMARK (' + ' '.join(argv) + ')', blue=True)
+    results = bench.run_benchmarks(n_names, fname_alter, n_alters, n_focals, num_workers)
+    fio.save_json(results, F_BENCH)
+
+    banner('Results (saved to ' + F_BENCH + ')', green=True)
+    for name, b in results['benchmarks'].items():
+        log_info(name.ljust(14) + str(b['items']).rjust(10) + ' in ' + ('%.2fs' % b['seconds']).rjust(9) +
+                 ' = ' + str(b['per_sec']).rjust(12) + ' /sec    peak ' + str(b.get('peak_mb')) + ' MB')
+
+    if f_baseline:
+        worse = bench.compare_results(fio.load_json(f_baseline), results)
+        for name, measure, old, new, ratio in worse:
+            log_warn(' ' + name + ' ' + measure + ': ' + str(old) + ' -> ' + str(new) + ' (x' + str(ratio) + ')')
+        if not worse: log_info('No regressions against ' + f_baseline)
+    print()
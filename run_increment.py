@@ -0,0 +1,22 @@
+"""
+    Match business names added to either list since the last incremental run (see match.match_increment),
+    and merge the new pairs into ~matched.csv and ~candidates.csv. The first run matches both lists in full.
+
+    MUST be run from the Command Line - not meant for importing!
+
+    Args:
+        argv[1] = file name of focal list
+        argv[2] = file name of alter list
+        argv[3] = number of worker processes   (optional)
+
+"""
+
+if __name__ == "__main__":
+    from   sys import argv
+    import match
+
+    fname_focal = str(argv[1])
+    fname_alter = str(argv[2])
+    num_workers = int(argv[3]) if len(argv) > 3 else 1
+
+    match.match_increment(fname_focal, fname_alter, num_workers)
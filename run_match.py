@@ -11,20 +11,18 @@
 
 """
 
-assert __name__ == "__main__", 'You must run this program from the command line.'
+if __name__ == "__main__":
+    from   sys import argv
+    import match
 
-from   sys import argv
-import match
+    fname_focal = str(argv[1])
+    fname_alter = str(argv[2])
 
-fname_focal = str(argv[1])
-fname_alter = str(argv[2])
-
-if len(argv) > 3:
-    num_batches = int(argv[3])
-    batch_no    = int(argv[4])
-else:
-    num_batches = 1
-    batch_no    = 0
-
-match.match_lists(fname_focal, fname_alter, num_batches, batch_no)
+    if len(argv) > 3:
+        num_batches = int(argv[3])
+        batch_no    = int(argv[4])
+    else:
+        num_batches = 1
+        batch_no    = 0
 
+    match.match_lists(fname_focal, fname_alter, num_batches, batch_no)
@@ -2,8 +2,13 @@
     BizNames: Test if running
 """
 
+import os
+import glob
+import shutil
+import tempfile
 import match
 import compare
+import fio
 from   datetime  import datetime
 from   support   import *
 
@@ -29,8 +34,8 @@ def test3():
     banner('TEST: Compare two names and date', blue=True)
     name1  = 'ALBANY MOLECULAR RESEARCH INC'
     name2  = 'ALBANY MOLECULAR RESRCH INC'
-    date1  = datetime.strptime('1999-12-31', '%Y-%M-%d')
-    date2  = datetime.strptime('1999-12-31', '%Y-%M-%d')
+    date1  = datetime.strptime('1999-12-31', '%Y-%m-%d').toordinal()
+    date2  = datetime.strptime('1999-12-31', '%Y-%m-%d').toordinal()
     clean1 = compare.clean_name(name1)
     clean2 = compare.clean_name(name2)
     matched, candidates = match._match_names(clean1, name1, date1, clean2, name2, date2)
@@ -42,13 +47,14 @@ def test4():
 
     rename_dct = match._load_rename_dict()
     a_lst      = match._load_bizname_list('_sdc_biznames.csv', rename_dct)
+    a_idx      = match.index_alters(a_lst)
 
     name1  = 'Hola Home Furnishings'
     clean1 = match.clean_name(name1, rename_dct)
     date1  = None
 
     print('Matching names...')
-    matched, candidates = match._match_alters(clean1, name1, date1, a_lst, rename_dct)
+    matched, candidates = match._match_alters(clean1, name1, date1, a_idx, rename_dct)
     if matched:
         for focal, alter in matched:
             print('MATCH FOUND:', focal, ' == ', alter)
@@ -58,12 +64,59 @@ def test4():
         for focal, alter in candidates:
             print('CANDIDATE MATCH FOUND:', focal, ' == ', alter)
 
+def test5():
+    banner('TEST: Match appended rows incrementally (same names on other dates, same alters twice)', blue=True)
+    focal  = ['Acme Widgets,2006-01-03', 'Acme Widgets,2008-06-01', 'Hola Home Furnishings,2007-03-05']
+    alters = [['Acme Widgets Co,2006-01-04', 'Hola Home Furnishing,2007-03-06'],
+              ['ACME WIDGETS INC,2008-06-02', 'Acme Widgets Co,2006-01-04'],
+              ['Acme Widgets Corp,2008-06-03', 'Hola Home Furnishings Inc,2007-03-05', 'Hola Home Furnishngs,2007-03-04']]
+
+    cwd = os.getcwd()
+    one_2_many = match.ALLOW_ONE_2_MANY
+    with tempfile.TemporaryDirectory() as tmp:
+        for fname in glob.glob('+*'): shutil.copy(fname, tmp)
+        os.chdir(tmp)
+        try:
+            for match.ALLOW_ONE_2_MANY in [True, False]:
+                fio.delete_files_by_prefix('.', '~')
+                with open('focal.csv', 'w') as f: f.write('\n'.join(focal) + '\n')
+                open('alter.csv', 'w').close()
+                for rows in alters:   # append the alters a few at a time
+                    with open('alter.csv', 'a') as f: f.write('\n'.join(rows) + '\n')
+                    match.match_increment('focal.csv', 'alter.csv')
+                increment = (fio.load_csv(match.F_MATCHED), fio.load_csv(match.F_CANDIDATES))
+                match.match_lists('focal.csv', 'alter.csv')
+                match.save_results(fio.load_csv('~matched.000'), fio.load_csv('~candidates.000'))
+                full      = (fio.load_csv(match.F_MATCHED), fio.load_csv(match.F_CANDIDATES))
+                print('ALLOW_ONE_2_MANY =', match.ALLOW_ONE_2_MANY, ':', 'SAME as a full run' if increment == full else 'DIFFERENT from a full run')
+        finally:
+            match.ALLOW_ONE_2_MANY = one_2_many
+            os.chdir(cwd)
+
+def test6():
+    banner('TEST: Keep the k best candidates (same alters on several rows)', blue=True)
+    rename_dct = match._load_rename_dict()
+    a_lst      = [(match.clean_name(name, rename_dct), name, None)
+                  for name in ['Acme Widgets', 'ACME WIDGETS', 'Acme Wxdgets', 'Acme Widgetts', 'ACME WIDGETS']]
+    a_idx      = match.index_alters(a_lst)
+
+    name1  = 'Acme Widgetz'
+    clean1 = match.clean_name(name1, rename_dct)
+    _, candidates = match._match_alters(clean1, name1, None, a_idx, rename_dct, top_k=0)
+    _, ranked     = match._match_alters(clean1, name1, None, a_idx, rename_dct, top_k=5)
+    for focal, alter, dist, ratio in ranked:
+        print('CANDIDATE MATCH FOUND:', focal, ' == ', alter, '(distance', str(dist) + ', ratio', str(ratio) + ')')
+    same = sorted(set(alter for _, alter in candidates)) == sorted(alter for _, alter, _, _ in ranked)
+    print('Top 5:', 'SAME alters as all candidates' if same else 'DIFFERENT alters from all candidates')
+
 if __name__ == "__main__":
     print()
     test1()
     test2()
     test3()
     test4()
+    test5()
+    test6()
     print()
     print()
 
@@ -6,11 +6,12 @@ from os import path
 
 CANDID_DIFF        = 3                  # max allowed diff in strings for candidates
 CANDID_THRESHOLD   = 0.71               # min ratio between strings for candidates
+CANDID_TOP_K       = 0                  # keep only the k best candidates per focal name, ranked and scored (0 = keep all)
 ALLOW_ONE_2_MANY   = True
 
 ALLOW_DAYS_BEFORE  = 5                  # OK for ALTER to be this # days before focal
 ALLOW_DAYS_AFTER   = 5                  # OK for ALTER to be this # days after focal
-DATE_FORMAT        = '%Y-%M-%d'         # formatted for US date order
+DATE_FORMAT        = '%Y-%m-%d'         # formatted for US date order
 
 PATH_CONFIG_FILES  = path.dirname(path.realpath(__file__)) + '/'  # Points to installation path from PIP, but you can over-ride to some other project directory
 
@@ -21,7 +22,21 @@ F_REPLACE          = '+replace.csv'
 F_SKIP             = '+skip.txt'
 F_STEM             = '+stem.txt'
 
-F_MATCHED          = '~matched.csv'     # Output - matched business names
-F_CANDIDATES       = '~candidates.csv'  # Output - candidate names to consider for matching
+MATCH_ENGINE       = 'scan'             # How alters are found for a focal: 'scan' (its blocks), 'ngram' (trigram index, for large alter lists), 'bktree' or 'symspell'
+INDEX_MIN_VISIT    = 2000               # Fewest alters a focal name must visit (in its blocks and date window) before any engine but 'scan' searches its index; fewer get scanned
+SYMSPELL_DISTANCE  = 2                  # Max chars deleted per name in the 'symspell' index (names that need more get scanned)
+
+WORKER_CHUNK_SIZE  = 25                 # focal names handed to a worker process at a time (costliest first)
 
+PATH_CACHE         = '.bizmatch/'       # Cleaned names are cached here between runs (relative to the working directory)
+USE_CACHE          = True
+INDEX_EXT          = '.idx'             # Prebuilt alter index (see build_index.py), saved next to the alter list
+INCREMENT_SEGMENTS = 8                  # alter index segments that incremental runs add before the newer ones get merged into one
 
+PROFILE            = False              # Count and time each matching stage, and report them in F_PROFILE
+
+F_MATCHED          = '~matched.csv'     # Output - matched business names
+F_CANDIDATES       = '~candidates.csv'  # Output - candidate names to consider for matching
+F_PROFILE          = '~profile.json'    # Output - stage counts and timings (if PROFILE is on)
+F_BENCH            = '~bench.json'      # Output - benchmark results (see run_bench.py)
+F_INCREMENT        = '~increment'       # Output - what incremental runs matched so far (.json, .focals, .matched, .candidates and .#.idx files, see run_increment.py)
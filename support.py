@@ -6,6 +6,8 @@ import os
 import logging
 import traceback
 import json
+from time       import perf_counter
+from settings   import PROFILE
 
 
 # CONSTANTS ------------------------------------------------------------------------------------------------------------
@@ -184,6 +186,52 @@ def log(msg, warn_txt=False, info_txt=False, err_txt=False, ljust=False, fcolor=
         except: pass
 
 
+# PROFILING ------------------------------------------------------------------------------------------------------------
+
+PROFILE_STATS = dict()   # stage -> {'calls': .., 'seconds': .., 'items': ..}, only collected if PROFILE is on
+
+def profiled(stage):
+    """Decorator that counts and times each call under stage (and leaves the function alone if PROFILE is off)."""
+    def wrap(fn):
+        if not PROFILE: return fn
+        def timed(*args, **kwargs):
+            start = perf_counter()
+            try:     return fn(*args, **kwargs)
+            finally: profile_add(stage, perf_counter() - start)
+        timed.__name__ = fn.__name__
+        timed.__doc__  = fn.__doc__
+        return timed
+    return wrap
+
+def profile_add(stage, seconds=0.0, items=0, calls=1):
+    stats = PROFILE_STATS.get(stage)
+    if stats is None: stats = PROFILE_STATS[stage] = dict(calls=0, seconds=0.0, items=0)
+    stats['calls']   += calls
+    stats['seconds'] += seconds
+    stats['items']   += items
+
+def profile_merge(stats):
+    """Add stats (from another process or batch) into PROFILE_STATS."""
+    for stage, s in (stats or {}).items():
+        profile_add(stage, s['seconds'], s['items'], s['calls'])
+
+def profile_take():
+    """PROFILE_STATS so far (e.g. to hand back from a worker process), starting over from zero."""
+    stats = dict(PROFILE_STATS)
+    PROFILE_STATS.clear()
+    return stats
+
+def profile_report(stats):
+    """Stats sorted on stage, with the average time per call and per item."""
+    report = dict()
+    for stage in sorted(stats):
+        s = dict(stats[stage])
+        s['us_per_call'] = round(s['seconds'] / s['calls'] * 1e6, 3) if s['calls'] else 0
+        s['us_per_item'] = round(s['seconds'] / s['items'] * 1e6, 3) if s['items'] else 0
+        report[stage] = s
+    return report
+
+
 # MISC OTHER -----------------------------------------------------------------------------------------------------------
 
 def break_points(lst, batch_no, num_batches):
@@ -195,6 +243,23 @@ def break_points(lst, batch_no, num_batches):
     if idx_stop > len(lst): idx_stop = len(lst)  # possibly cut short final batch
     return idx_start, idx_stop
 
+def schedule_chunks(costs, chunk_size):
+    """
+    Group item indexes into small chunks to hand out to workers on demand, most expensive first.
+
+    Static slices finish whenever their costliest items do; handing out the expensive chunks first
+    (and the cheap ones last, to whichever worker frees up) keeps every worker busy until the end.
+
+    Args:
+        costs:          estimated cost of each item
+        chunk_size:     max number of items per chunk
+
+    Return:
+        list of chunks (lists of item indexes), in the order to hand them out
+    """
+    order = sorted(range(len(costs)), key=lambda i: costs[i], reverse=True)
+    return [order[i:i + chunk_size] for i in range(0, len(order), chunk_size)]
+
 # Print iterations progress when match.py is called from the command line
 def printProgressBar(iteration, total, prefix = '', suffix = '', decimals = 1, length = 100, fill = '█'):
     """